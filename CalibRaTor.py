@@ -3,10 +3,111 @@ import numpy as np
 import os
 import pickle
 
+from datetime import datetime
+
 # import the APIs
 import api.daq  as daq
 import api.calc as calc
 
+from api         import profiling
+from api.catalog import Catalog
+from api.results import Results
+from api.session import Session, default_session
+
+def _load_histograms(catalog, crt, run, stage):
+  """Loads the histograms of a CRT module acquired in the given stage of a run"""
+
+  return [snapshot[1:] for snapshot in calc.iter_histograms(
+    catalog,
+    crts=crt,
+    run=run,
+    stage=stage
+  )]
+
+
+def _compute_gains(histograms, sipms, task_output, task_input, session, stream=False, target=.1, timeout=60.):
+  """Returns the peaks, distances and gains of the given SiPMs.
+  If stream is set, the gains are estimated while the fitter responds
+  and the tasks of a SiPM are cancelled once its gain is precise enough.
+  The SiPMs still waiting when the fitter doesn't respond within timeout
+  seconds fail."""
+
+  if stream:
+    return calc.stream_gains(
+      histograms,
+      sipms=sipms,
+      target=target,
+      output_socket=task_output,
+      input_socket=task_input,
+      timeout=timeout,
+      session=session
+    )
+
+  peaks, distances = calc.get_peaks_and_distances(
+    histograms,
+    output_socket=task_output,
+    input_socket=task_input,
+    sipms=sipms,
+    session=session
+  )
+  return peaks, distances, calc.get_gains(distances, sipms, target=target)
+
+
+def _fit_joint(catalog, crt, bias_settings, sipms, run):
+  """Returns the dependencies {sipm: (slope, offset)} and the gains
+  {(sipm, bias): ((A, mu, sigma), pcov)} of the given SiPMs of a CRT
+  module, fitting the spectra of all the bias settings at once"""
+
+  spectra = []
+  pedestals = []
+  for bias in bias_settings:
+    histograms = _load_histograms(catalog, crt, run, 'bias_%d' % bias)
+    if not histograms:
+      print("  No histograms for bias %d" % bias)
+      return {}, {}
+    spectra.append(np.sum([ss for config, pp, ss in histograms], axis=0))
+    pedestals.append(np.sum([pp for config, pp, ss in histograms], axis=0))
+
+  sipms = list(sipms)
+  params, covariance, quality = calc.fit_joint(
+    np.swapaxes(spectra, 0, 1)[sipms],
+    np.swapaxes(pedestals, 0, 1)[sipms],
+    bias_settings
+  )
+
+  dependencies = {}
+  gains = {}
+  for sipm, (slope, offset, pedestal, noise, spread), cov in zip(sipms, params, covariance):
+    if np.isnan(slope):
+      continue
+    dependencies[sipm] = (slope, offset)
+    for bias in bias_settings:
+      # the uncertainty of the gain at the bias from the covariance
+      variance = np.array([bias, 1.]) @ cov[:2, :2] @ np.array([bias, 1.])
+      gains[(sipm, bias)] = ((np.nan, slope * bias + offset, spread), np.diag([0., variance, 0.]))
+
+  print('  Fitted %d SiPMs, %d failed' % (len(dependencies), len(sipms) - len(dependencies)))
+
+  return dependencies, gains
+
+
+def _store_gains(results, run, gains, stage):
+  """Stores the gains {(crt, sipm, bias): ((A, mu, sigma), pcov)}"""
+
+  keys = list(gains)
+  results.add(
+    'gains',
+    run,
+    crt=[crt for crt, _, _ in keys],
+    sipm=[sipm for _, sipm, _ in keys],
+    bias=[bias for _, _, bias in keys],
+    stage=stage,
+    gain=[gains[key][0][1] for key in keys],
+    width=[gains[key][0][2] for key in keys],
+    error=[np.sqrt(gains[key][1][1][1]) for key in keys]
+  )
+
+
 def calibrate(
   crts,
   gain=75,
@@ -18,9 +119,39 @@ def calibrate(
   task_output='tcp://localhost:7000',
   task_input='tcp://localhost:8000',
   path='data',
-  sipms=range(32)
+  sipms=range(32),
+  session=None,
+  archive=False,
+  results=None,
+  export_text=False,
+  stream=False,
+  target=.1,
+  fitter_timeout=60.,
+  report=False,
+  report_processes=None,
+  shards=1,
+  joint=False,
+  nr_histograms=12
 ):
 
+  # share one zeromq context and its sockets among all the steps
+  session = session or default_session()
+
+  # the diagnostics module imports plotly, only load it if needed
+  if report:
+    from api.diagnostics import store_fits, generate_report
+
+  # the bias settings to scan, bias_settings gets reused for the results
+  bias_points = list(bias_settings)
+
+  # the acquired histograms are recorded in the catalog of the data folder
+  catalog = Catalog(path)
+
+  # the results are stored in the results database of the data folder
+  own_results = results is None
+  results = results or Results('%s/results.sqlite' % path)
+  run = results.new_run(description='calibrate')
+
   # load the configuration file
   daq.load_config_file(path=conf, febs=crts)
 
@@ -29,86 +160,130 @@ def calibrate(
     print("Acquiring data for bias %d" % bias)
     os.makedirs('%s/bias_%d' % (path, bias), exist_ok=True)
     daq.set_voltages(bias, crts)
-    daq.acquire(
-      crts,
-      path='%s/bias_%d' % (path, bias),
-      driver=driver,
-      data=data
-    )
+    with profiling.region('calibrate.acquire'):
+      daq.acquire(
+        crts,
+        path='%s/bias_%d' % (path, bias),
+        driver=driver,
+        data=data,
+        session=session,
+        archive=archive,
+        catalog=catalog,
+        bias=bias,
+        run=run,
+        stage='bias_%d' % bias,
+        shards=shards,
+        nr_histograms=nr_histograms
+      )
 
-  # compute the gains for each bias voltage
+  # fit the spectra of all the bias settings at once,
+  # the gain is linear in the bias, which gives the dependencies
   gains = {}
-  for bias in bias_settings:
-    print("Loading the generated histograms for bias %d" % bias)
-    histograms = calc.get_histograms('%s/bias_%d/*.histos' % (path, bias))
+  dependencies = {}
+  if joint:
     for crt in crts:
-      print("Fitting the peaks for CRT %d" % crt)
-      peaks, distances = calc.get_peaks_and_distances(
-          histograms[crt],
-          output_socket=task_output,
-          input_socket=task_input,
-          sipms=sipms
-      )
-      print("Computing the gains for CRT %d" % crt)
-      _gains = calc.get_gains(distances, sipms)
-      for sipm in _gains:
-        gains[(crt, sipm, bias)] = _gains[sipm]
+      print("Fitting the spectra of CRT %d for all the bias settings" % crt)
+      with profiling.region('calibrate.fit'):
+        _dependencies, _gains = _fit_joint(catalog, crt, bias_settings, sipms, run)
+      for sipm in _dependencies:
+        dependencies[(crt, sipm)] = _dependencies[sipm]
+      for sipm, bias in _gains:
+        gains[(crt, sipm, bias)] = _gains[(sipm, bias)]
 
-  # Store the gains in a text file
-  for crt in crts:
+      # keep the fit results, the report is rendered after the run
+      if report:
+        for bias in bias_settings:
+          store_fits(path, crt, bias, {}, {}, {sipm: _gains[(sipm, bias)] for sipm in _dependencies})
+
+  # or compute the gains for each bias voltage
+  if not joint:
     for bias in bias_settings:
-      f = open(
-        '%s/bias_%d/%02x-%s.gains' % (args.path, bias, crt, str(datetime.now())),
-        'w'
-      )
-      _sipms = [sipm for sipm in sipms if (crt, sipm, bias) in gains]
-      _gains = [gains[(crt, sipm, bias)][0][1] for sipm in sipms if (crt, sipm, bias) in gains]
-      _uncerts = [gains[(crt, sipm, bias)][0][2] for sipm in sipms if (crt, sipm, bias) in gains]
-      f.write("\n".join(["%d: %.2f (%.2f)" % (_s, _g, _u)
-        for _s, _g, _u in zip(_sipms, _gains, _uncerts)
-      ]))
-      f.close()
+      for crt in crts:
+        print("Loading the generated histograms of CRT %d for bias %d" % (crt, bias))
+        with profiling.region('calibrate.load'):
+          histograms = _load_histograms(catalog, crt, run, 'bias_%d' % bias)
+        print("Fitting the peaks for CRT %d" % crt)
+        with profiling.region('calibrate.fit'):
+          peaks, distances, _gains = _compute_gains(
+              histograms,
+              sipms,
+              task_output,
+              task_input,
+              session,
+              stream=stream,
+              target=target,
+              timeout=fitter_timeout
+          )
+        for sipm in _gains:
+          gains[(crt, sipm, bias)] = _gains[sipm]
+
+        # keep the fit results, the report is rendered after the run
+        if report:
+          store_fits(path, crt, bias, peaks, distances, _gains)
+
+  # Store the gains
+  _store_gains(results, run, gains, 'scan')
+
+  # Export the gains to text files
+  if export_text:
+    for crt in crts:
+      for bias in bias_settings:
+        results.export(
+          'gains',
+          '%s/bias_%d/%02x-%s.gains' % (path, bias, crt, str(datetime.now())),
+          run,
+          crt,
+          bias=bias,
+          stage='scan'
+        )
   print("Stored the computed gains")
 
   # compute the dependencies of the gain on the bias for each sipm
   print("Computing the dependencies of the gains on the bias setting")
-  dependencies = {}
-  for crt in crts:
-    for sipm in sipms:
-      # require at least 3 valid gains to compute the dependency
-      if len([1
-        for bias in bias_settings
-        if (crt, sipm, bias) in gains
-      ]) >= 3:
-
-        a, b = np.polyfit(
-          [bias for bias in bias_settings if (crt, sipm, bias) in gains],
-          [gains[(crt, sipm, bias)][0][1]
+  with profiling.region('calibrate.dependencies'):
+    if not joint:
+      for crt in crts:
+        for sipm in sipms:
+          # require at least 3 valid gains to compute the dependency
+          if len([1
             for bias in bias_settings
             if (crt, sipm, bias) in gains
-          ],
-          1,
-          w=[1./gains[(crt, sipm, bias)][0][2]
-            for bias in bias_settings
-            if (crt, sipm, bias) in gains
-          ]
-        )
-        # TODO: use the uncertainties!
-        dependencies[(crt, sipm)] = (a, b)
+          ]) >= 3:
 
-  # Store the dependencies in a text file
-  for crt in crts:
-    f = open(
-      '%s/%02x-%s.dependencies' % (args.path, crt, str(datetime.now())),
-      'w'
-    )
-    _sipms = [sipm for sipm in sipms if (crt, sipm) in dependencies]
-    _aa = [dependencies[(crt, sipm)][0] for sipm in sipms if (crt, sipm) in dependencies]
-    _bb = [dependencies[(crt, sipm)][1] for sipm in sipms if (crt, sipm) in dependencies]
-    f.write("SiPM\tSlope\tOffset" + "\n".join(["%d\t%.2f\t%.2f" % (_s, _g, _u)
-      for _s, _g, _u in zip(_sipms, _aa, _bb)
-    ]))
-    f.close()
+            a, b = np.polyfit(
+              [bias for bias in bias_settings if (crt, sipm, bias) in gains],
+              [gains[(crt, sipm, bias)][0][1]
+                for bias in bias_settings
+                if (crt, sipm, bias) in gains
+              ],
+              1,
+              w=[1./gains[(crt, sipm, bias)][0][2]
+                for bias in bias_settings
+                if (crt, sipm, bias) in gains
+              ]
+            )
+            # TODO: use the uncertainties!
+            dependencies[(crt, sipm)] = (a, b)
+
+  # Store the dependencies
+  results.add(
+    'dependencies',
+    run,
+    crt=[crt for crt, _ in dependencies],
+    sipm=[sipm for _, sipm in dependencies],
+    slope=[a for a, _ in dependencies.values()],
+    offset=[b for _, b in dependencies.values()]
+  )
+
+  # Export the dependencies to text files
+  if export_text:
+    for crt in crts:
+      results.export(
+        'dependencies',
+        '%s/%02x-%s.dependencies' % (path, crt, str(datetime.now())),
+        run,
+        crt
+      )
   print("Stored the computed dependencies")
 
   # compute the bias for each sipm to get the right gain
@@ -123,26 +298,32 @@ def calibrate(
         bias_settings[(crt, sipm)] = _s
         if _s < bias_range[0]:
           print("  Bias below range for CRT Module %d SiPM %d - setting %d" % (crt, sipm, min(bias_range)))
-          bias_setting[(crt, sipm)] = min(bias_range)
+          bias_settings[(crt, sipm)] = min(bias_range)
         if _s > bias_range[1]:
           print("  Bias above range for CRT Module %d SiPM %d - setting %d" % (crt, sipm, max(bias_range)))
-          bias_setting[(crt, sipm)] = max(bias_range)
+          bias_settings[(crt, sipm)] = max(bias_range)
       else:
         print("  Bias setting couldn't be computed for CRT Module %d SiPM %d - setting %d" % (crt, sipm, int(sum(bias_range)/2)))
         bias_settings[(crt, sipm)] = int(sum(bias_range)/2)
 
-  # Store the computed bias settings in a text file
-  for crt in crts:
-    f = open(
-      '%s/%02x-%s.caliblated_bias_settings' % (args.path, crt, str(datetime.now())),
-      'w'
-    )
-    _sipms = [sipm for sipm in sipms if (crt, sipm) in bias_settings]
-    _bias = [bias_settings[(crt, sipm)] for sipm in sipms if (crt, sipm) in bias_settings]
-    f.write("SiPM\tbias" + "\n".join(["%d\t%d" % (_s, _b)
-      for _s, _b in zip(_sipms, _bias)
-    ]))
-    f.close()
+  # Store the computed bias settings
+  results.add(
+    'bias_settings',
+    run,
+    crt=[crt for crt, _ in bias_settings],
+    sipm=[sipm for _, sipm in bias_settings],
+    bias=list(bias_settings.values())
+  )
+
+  # Export the computed bias settings to text files
+  if export_text:
+    for crt in crts:
+      results.export(
+        'bias_settings',
+        '%s/%02x-%s.caliblated_bias_settings' % (path, crt, str(datetime.now())),
+        run,
+        crt
+      )
   print("Stored the computed bias settings")
 
   # acquire data to test the calibrated bias setting
@@ -150,39 +331,278 @@ def calibrate(
   for crt in crts:
     daq.set_voltages([bias_settings[(crt, sipm)] for sipm in sipms], crt)
   os.makedirs('%s/evaluation' % path, exist_ok=True)
-  daq.acquire(
-    crts,
-    path='%s/evaluation' % path,
-    driver=driver,
-    data=data
-  )
+  with profiling.region('calibrate.acquire'):
+    daq.acquire(
+      crts,
+      path='%s/evaluation' % path,
+      driver=driver,
+      data=data,
+      session=session,
+      archive=archive,
+      catalog=catalog,
+      run=run,
+      stage='evaluation',
+      shards=shards
+    )
 
   # Compute the gains for evaluation
   print("Computing the gains to evaluate calibration")
   gains = {}
-  histograms = calc.get_histograms('%s/evaluation/*.histos' % path)
   for crt in crts:
-    peaks, distances = calc.get_peaks_and_distances(histograms[crt])
-    _gains = calc.get_gains(distances, sipms)
-    for sipm, _g in zip(sipms, _gains):
-      gains[(crt, sipm)] = _g
+    with profiling.region('calibrate.load'):
+      histograms = _load_histograms(catalog, crt, run, 'evaluation')
+    with profiling.region('calibrate.fit'):
+      peaks, distances, _gains = _compute_gains(
+          histograms,
+          sipms,
+          task_output,
+          task_input,
+          session,
+          stream=stream,
+          target=target,
+          timeout=fitter_timeout
+      )
+    for sipm in _gains:
+      gains[(crt, sipm)] = _gains[sipm]
   print(gains)
 
   # Store the results
-  for crt in crts:
-    f = open(
-      '%s/evaluation/%02x-%s.gains' % (args.path, crt, str(datetime.now())),
-      'w'
-    )
-    _sipms = [sipm for sipm in sipms if (crt, sipm) in gains]
-    _gains = [gains[(crt, sipm)][0][1] for sipm in sipms if (crt, sipm) in gains]
-    _uncerts = [gains[(crt, sipm)][0][2] for sipm in sipms if (crt, sipm) in gains]
-    f.write("\n".join(["%d: %.2f (%.2f)" % (_s, _g, _u)
-      for _s, _g, _u in zip(_sipms, _gains, _uncerts)
-    ]))
-    f.close()
+  _store_gains(
+    results,
+    run,
+    {(crt, sipm, bias_settings[(crt, sipm)]): gains[(crt, sipm)] for crt, sipm in gains},
+    'evaluation'
+  )
+
+  # Export the results to text files
+  if export_text:
+    for crt in crts:
+      results.export(
+        'gains',
+        '%s/evaluation/%02x-%s.gains' % (path, crt, str(datetime.now())),
+        run,
+        crt,
+        stage='evaluation'
+      )
   print("Stored the computed gains")
 
+  catalog.close()
+  if own_results:
+    results.close()
+
+  # render the diagnostic report in worker processes
+  if report:
+    print("Generating the diagnostic report")
+    with profiling.region('calibrate.report'):
+      filenames = generate_report(
+        path,
+        crts,
+        bias_settings=bias_points,
+        sipms=sipms,
+        processes=report_processes,
+        run=run
+      )
+    for filename in filenames:
+      print("  Stored %s" % filename)
+
+
+def refine(
+  crts,
+  gain=75,
+  bias_range=[],
+  start_bias={},
+  slopes={},
+  slope=None,
+  step=5,
+  tolerance=.05,
+  max_rounds=6,
+  max_failures=2,
+  conf='CONF/SC.txt',
+  driver='tcp://localhost:5555',
+  data='tcp://localhost:5556',
+  task_output='tcp://localhost:7000',
+  task_input='tcp://localhost:8000',
+  path='data',
+  sipms=range(32),
+  session=None,
+  archive=False,
+  results=None,
+  export_text=False,
+  stream=False,
+  target=.1,
+  fitter_timeout=60.,
+  shards=1
+):
+  """Iteratively sets the bias of every SiPM until its gain is
+  within the relative tolerance of the nominal gain.
+
+  Each round acquires data for the CRT modules with SiPMs out of
+  tolerance and corrects their bias using Newton's method. The slopes
+  of the gain vs bias are taken from slopes {(crt, sipm): slope}, else
+  from slope, else from the latest results. Without any of them, they
+  are measured by stepping the bias by step after the first round.
+  The slopes are updated with every measurement. SiPMs without gain in
+  max_failures rounds, ex. dead or noisy channels, are given up.
+  Without start_bias, the latest bias settings are used.
+  Returns the bias settings {(crt, sipm): bias} and the gains of the
+  SiPMs which converged {(crt, sipm): gain}."""
+
+  # share one zeromq context and its sockets among all the steps
+  session = session or default_session()
+
+  # the acquired histograms are recorded in the catalog of the data folder
+  catalog = Catalog(path)
+
+  # the results are stored in the results database of the data folder
+  own_results = results is None
+  results = results or Results('%s/results.sqlite' % path)
+  run = results.new_run(description='refine')
+
+  # start from the latest calibration of the CRT modules
+  start_bias = start_bias or results.latest('bias_settings', crts)
+  if not slopes and slope is None:
+    slopes = {key: a for key, (a, b) in results.latest('dependencies', crts).items()}
+
+  # load the configuration file
+  daq.load_config_file(path=conf, febs=crts)
+
+  # the current bias setting, slope and last measurement of every SiPM
+  middle = int(sum(bias_range) / 2)
+  bias_settings = {(crt, sipm): start_bias.get((crt, sipm), middle) for crt in crts for sipm in sipms}
+  slopes = {key: slopes.get(key, slope) for key in bias_settings}
+  measured = {}
+  converged = {}
+  stuck = set()
+  failures = {}
+
+  for nr in range(max_rounds):
+    pending = [key for key in bias_settings if key not in converged and key not in stuck]
+    if not pending:
+      break
+
+    _crts = sorted(set(crt for crt, _ in pending))
+    print("Round %d: %d SiPMs of %d CRT modules out of tolerance" % (nr, len(pending), len(_crts)))
+
+    # acquire data with the current bias settings
+    round_path = '%s/refine_%d' % (path, nr)
+    os.makedirs(round_path, exist_ok=True)
+    for crt in _crts:
+      daq.set_voltages([bias_settings[(crt, sipm)] if (crt, sipm) in bias_settings else middle
+        for sipm in range(32)
+      ], crt)
+    with profiling.region('refine.acquire'):
+      daq.acquire(
+        _crts,
+        path=round_path,
+        driver=driver,
+        data=data,
+        session=session,
+        archive=archive,
+        catalog=catalog,
+        run=run,
+        stage='refine_%d' % nr,
+        shards=shards
+      )
+
+    # compute the gains of the pending SiPMs
+    for crt in _crts:
+      _sipms = [sipm for _c, sipm in pending if _c == crt]
+      with profiling.region('refine.load'):
+        histograms = _load_histograms(catalog, crt, run, 'refine_%d' % nr)
+      print("Fitting the peaks for CRT %d" % crt)
+      with profiling.region('refine.fit'):
+        peaks, distances, _gains = _compute_gains(
+            histograms,
+            _sipms,
+            task_output,
+            task_input,
+            session,
+            stream=stream,
+            target=target,
+            timeout=fitter_timeout
+        )
+      _store_gains(
+        results,
+        run,
+        {(crt, sipm, bias_settings[(crt, sipm)]): _gains[sipm] for sipm in _gains},
+        'refine_%d' % nr
+      )
+
+      # correct the bias settings
+      for sipm in _sipms:
+        key = (crt, sipm)
+        if sipm not in _gains:
+          print("  No gain for CRT Module %d SiPM %d at bias %d" % (crt, sipm, bias_settings[key]))
+          failures[key] = failures.get(key, 0) + 1
+          if failures[key] >= max_failures:
+            stuck.add(key)
+          continue
+
+        _g = _gains[sipm][0][1]
+        _b = bias_settings[key]
+
+        if abs(_g - gain) <= tolerance * gain:
+          converged[key] = _g
+          continue
+
+        # update the slope with the secant of the last two measurements
+        if key in measured and measured[key][0] != _b:
+          _s = (_g - measured[key][1]) / (_b - measured[key][0])
+          if _s > 0:
+            slopes[key] = _s
+        measured[key] = (_b, _g)
+
+        # without slope, step the bias towards the nominal gain to measure it
+        if slopes[key] is None:
+          _new = _b + (step if _g < gain else -step)
+        else:
+          _new = int(round(_b + (gain - _g) / slopes[key]))
+        _new = min(max(_new, bias_range[0]), bias_range[1])
+
+        # the bias can't be set any closer or is out of range
+        if _new == _b:
+          print("  Bias of CRT Module %d SiPM %d can't be corrected further - gain %.2f" % (crt, sipm, _g))
+          stuck.add(key)
+          continue
+
+        bias_settings[key] = _new
+
+  for crt, sipm in sorted(bias_settings):
+    if (crt, sipm) in converged:
+      continue
+    if failures.get((crt, sipm), 0) >= max_failures:
+      print("  CRT Module %d SiPM %d did not converge, no gain in %d rounds - setting %d" % (
+        crt, sipm, failures[(crt, sipm)], bias_settings[(crt, sipm)]
+      ))
+    else:
+      print("  CRT Module %d SiPM %d did not converge - setting %d" % (crt, sipm, bias_settings[(crt, sipm)]))
+
+  # Store the refined bias settings
+  results.add(
+    'bias_settings',
+    run,
+    crt=[crt for crt, _ in bias_settings],
+    sipm=[sipm for _, sipm in bias_settings],
+    bias=list(bias_settings.values())
+  )
+
+  # Export the refined bias settings to text files
+  if export_text:
+    for crt in crts:
+      results.export(
+        'bias_settings',
+        '%s/%02x-%s.caliblated_bias_settings' % (path, crt, str(datetime.now())),
+        run,
+        crt
+      )
+  print("Stored the refined bias settings")
+
+  catalog.close()
+  if own_results:
+    results.close()
+
+  return bias_settings, converged
+
 
 if __name__ == '__main__':
 
@@ -225,6 +645,14 @@ if __name__ == '__main__':
     '--stats', nargs='?', type=str, default='tcp://localhost:5557',
     help='Socket to stats               Ex. tcp://localhost:5557'
   )
+  parser.add_argument(
+    '--stats_timeout', nargs='?', type=float, default=10.,
+    help='Seconds to wait for the stats of the connected FEBs'
+  )
+  parser.add_argument(
+    '--fitter_timeout', nargs='?', type=float, default=60.,
+    help='Seconds to wait for a response of the fitter when streaming before failing the waiting SiPMs'
+  )
   parser.add_argument(
     '--conf', nargs='?', type=str, default='CONF/SC.txt',
     help='Path to template config file  Ex. CONF/SC.txt'
@@ -233,22 +661,178 @@ if __name__ == '__main__':
     '--path', nargs='?', type=str, default='data',
     help='Path to folder where the adquired data and results are stored'
   )
+  parser.add_argument(
+    '--archive', action='store_true',
+    help='Store the acquired histograms in compressed archives instead of pickles'
+  )
+  parser.add_argument(
+    '--results', nargs='?', type=str, default=None,
+    help='Path to the results database  (default: results.sqlite in the data folder)'
+  )
+  parser.add_argument(
+    '--export_text', action='store_true',
+    help='Also export the gains, dependencies and bias settings to text files'
+  )
+  parser.add_argument(
+    '--stream', action='store_true',
+    help='Estimate the gains while the fitters respond and cancel the remaining tasks of precise SiPMs'
+  )
+  parser.add_argument(
+    '--target', nargs='?', type=float, default=.1,
+    help='Relative uncertainty of the gains required to accept them'
+  )
+  parser.add_argument(
+    '--refine', action='store_true',
+    help='Iteratively correct the bias of each SiPM instead of scanning the bias settings'
+  )
+  parser.add_argument(
+    '--tolerance', nargs='?', type=float, default=.05,
+    help='Relative tolerance of the gain when refining'
+  )
+  parser.add_argument(
+    '--max_rounds', nargs='?', type=int, default=6,
+    help='Maximum number of acquisitions when refining'
+  )
+  parser.add_argument(
+    '--max_failures', nargs='?', type=int, default=2,
+    help='Number of rounds without gain after which a SiPM is given up when refining'
+  )
+  parser.add_argument(
+    '--slope', nargs='?', type=float, default=None,
+    help='Initial slope of the gain vs bias when refining (default: latest results, else measured)'
+  )
+  parser.add_argument(
+    '--report', action='store_true',
+    help='Render a diagnostic html report into the data folder after the run'
+  )
+  parser.add_argument(
+    '--report_processes', nargs='?', type=int, default=None,
+    help='Number of processes rendering the report (default: number of cores)'
+  )
+  parser.add_argument(
+    '--profile', nargs='*', type=str, default=None,
+    help='Profile the given regions or stages (default: all) into the profile folder of the data folder  Ex. daq calc.fitter'
+  )
+  parser.add_argument(
+    '--joint', action='store_true',
+    help='Fit the spectra of all the bias settings at once, the gain being linear in the bias'
+  )
+  parser.add_argument(
+    '--histograms', nargs='?', type=int, default=12,
+    help='Number of histograms of 5000 events to acquire per bias setting'
+  )
+  parser.add_argument(
+    '--shards', nargs='?', type=int, default=1,
+    help='Number of processes receiving the histograms, on consecutive ports from 6000'
+  )
+  parser.add_argument(
+    '--io_threads', nargs='?', type=int, default=1,
+    help='Number of zeromq I/O threads'
+  )
+  parser.add_argument(
+    '--hwm', nargs='?', type=int, default=1000,
+    help='High water mark of the zeromq sockets'
+  )
+  parser.add_argument(
+    '--linger', nargs='?', type=int, default=0,
+    help='Milliseconds to keep unsent messages when closing a socket'
+  )
   args = parser.parse_args()
 
-  crts = args.crt or daq.connected_febs(socket=args.stats)
-  bias_range = args.bias_range or [min(args.bias), max(args.bias)]
+  if args.joint and not args.refine and len(set(args.bias)) < 2:
+    parser.error('--joint needs at least two distinct --bias settings')
 
-  calibrate(
-    crts,
-    gain=args.gain,
-    bias_settings=args.bias,
-    bias_range=bias_range,
-    conf=args.conf,
-    driver=args.driver,
-    data=args.data,
-    path=args.path,
-    task_output=args.fitter_input,  # input, output, it's all a point of view
-    task_input=args.fitter_output,
-    sipms=range(32)
+  # one zeromq context and pool of sockets for the whole run
+  session = Session(
+    io_threads=args.io_threads,
+    sndhwm=args.hwm,
+    rcvhwm=args.hwm,
+    linger=args.linger
   )
 
+  # keep track of the connected febs during the calibration
+  registry = daq.FEBRegistry(socket=args.stats, session=session).start()
+
+  crts = args.crt or daq.connected_febs(registry=registry, timeout=args.stats_timeout)
+  bias_range = args.bias_range or [min(args.bias), max(args.bias)]
+
+  # warn about modules which are not connected or report errors
+  if registry.wait(timeout=args.stats_timeout):
+    healthy = registry.healthy(crts, configured=False)
+    for crt in crts:
+      if crt not in healthy:
+        print("CRT Module %d is not connected or reports errors" % crt)
+
+  # profile the stages of the run
+  if args.profile is not None:
+    profiling.start(
+      '%s/profile/%s' % (args.path, str(datetime.now())),
+      regions=args.profile or None
+    )
+
+  # the results of all the runs are kept in one database
+  results = Results(args.results or '%s/results.sqlite' % args.path)
+
+  try:
+    if args.refine:
+      refine(
+        crts,
+        gain=args.gain,
+        bias_range=bias_range,
+        slope=args.slope,
+        tolerance=args.tolerance,
+        max_rounds=args.max_rounds,
+      max_failures=args.max_failures,
+        conf=args.conf,
+        driver=args.driver,
+        data=args.data,
+        path=args.path,
+        task_output=args.fitter_input,
+        task_input=args.fitter_output,
+        sipms=range(32),
+        session=session,
+        archive=args.archive,
+        results=results,
+        export_text=args.export_text,
+        stream=args.stream,
+        target=args.target,
+        fitter_timeout=args.fitter_timeout,
+        shards=args.shards
+      )
+
+    else:
+      calibrate(
+        crts,
+        gain=args.gain,
+        bias_settings=args.bias,
+        bias_range=bias_range,
+        conf=args.conf,
+        driver=args.driver,
+        data=args.data,
+        path=args.path,
+        task_output=args.fitter_input,  # input, output, it's all a point of view
+        task_input=args.fitter_output,
+        sipms=range(32),
+        session=session,
+        archive=args.archive,
+        results=results,
+        export_text=args.export_text,
+        stream=args.stream,
+        target=args.target,
+        fitter_timeout=args.fitter_timeout,
+        report=args.report,
+        report_processes=args.report_processes,
+        shards=args.shards,
+        joint=args.joint,
+        nr_histograms=args.histograms
+      )
+
+  # close everything and keep the profiles, also of failed runs
+  finally:
+    results.close()
+    registry.stop()
+    session.close()
+
+    if args.profile is not None:
+      print("Stored the profiles, summary in %s" % profiling.stop())
+
@@ -0,0 +1,121 @@
+import argparse
+import os
+
+# import the APIs
+import api.daq as daq
+
+from api.monitor import GainMonitor
+from api.results import Results
+from api.session import Session
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(
+    description='Monitors the gain drift of CRT modules'
+  )
+  parser.add_argument(
+    '--crt', nargs='*', type=int, default=[],
+    help='CRT modules to monitor'
+  )
+  parser.add_argument(
+    '--bias', nargs='?', type=int, default=None,
+    help='Bias setting of the SiPMs without calibrated bias setting (default: the one in the config file)'
+  )
+  parser.add_argument(
+    '--results', nargs='?', type=str, default='data/results.sqlite',
+    help='Results database with the calibrated bias settings'
+  )
+  parser.add_argument(
+    '--gain', nargs='?', type=float, default=None,
+    help='Reference gain in adc/p.e. (default: the first estimated gain)'
+  )
+  parser.add_argument(
+    '--tolerance', nargs='?', type=float, default=.05,
+    help='Relative drift of the gain raising an alert'
+  )
+  parser.add_argument(
+    '--half_life', nargs='?', type=float, default=600.,
+    help='Seconds after which the weight of a histogram is halved'
+  )
+  parser.add_argument(
+    '--interval', nargs='?', type=float, default=60.,
+    help='Seconds between the estimations of the gains'
+  )
+  parser.add_argument(
+    '--min_events', nargs='?', type=int, default=50000,
+    help='New entries in a spectrum required to re-estimate its gain'
+  )
+  parser.add_argument(
+    '--duration', nargs='?', type=float, default=None,
+    help='Seconds to monitor (default: until interrupted)'
+  )
+  parser.add_argument(
+    '--publish', nargs='?', type=str, default='tcp://*:6500',
+    help='Socket to publish gains and alerts on Ex. tcp://*:6500'
+  )
+  parser.add_argument(
+    '--driver', nargs='?', type=str, default='tcp://localhost:5555',
+    help='Socket to driver              Ex. tcp://localhost:5555'
+  )
+  parser.add_argument(
+    '--data', nargs='?', type=str, default='tcp://localhost:5556',
+    help='Socket to data                Ex. tcp://localhost:5556'
+  )
+  parser.add_argument(
+    '--stats', nargs='?', type=str, default='tcp://localhost:5557',
+    help='Socket to stats               Ex. tcp://localhost:5557'
+  )
+  parser.add_argument(
+    '--stats_timeout', nargs='?', type=float, default=10.,
+    help='Seconds to wait for the stats of the connected FEBs'
+  )
+  parser.add_argument(
+    '--conf', nargs='?', type=str, default='CONF/SC.txt',
+    help='Path to template config file  Ex. CONF/SC.txt'
+  )
+  args = parser.parse_args()
+
+  session = Session()
+
+  crts = args.crt or daq.connected_febs(
+    socket=args.stats,
+    timeout=args.stats_timeout,
+    session=session
+  )
+
+  # configure the CRT modules with their calibrated bias settings
+  daq.load_config_file(path=args.conf, febs=crts)
+  calibrated = {}
+  if os.path.exists(args.results):
+    with Results(args.results) as results:
+      calibrated = results.latest('bias_settings', crts)
+  for crt in crts:
+    voltages = daq.get_voltages(crt) if args.bias is None else [args.bias]*32
+    daq.set_voltages([calibrated.get((crt, sipm), voltages[sipm]) for sipm in range(32)], crt)
+
+  reference = {}
+  if args.gain is not None:
+    reference = {(crt, sipm): args.gain for crt in crts for sipm in range(32)}
+
+  monitor = GainMonitor(
+    crts,
+    reference=reference,
+    tolerance=args.tolerance,
+    half_life=args.half_life,
+    interval=args.interval,
+    min_events=args.min_events,
+    session=session
+  )
+  drifted = monitor.run(
+    duration=args.duration,
+    driver=args.driver,
+    data=args.data,
+    publish=args.publish
+  )
+
+  # the channels to recalibrate
+  for crt, sipm in sorted(drifted):
+    print("CRT Module %d SiPM %02d drifted by %+.1f%%" % (crt, sipm, 100 * drifted[(crt, sipm)]))
+
+  session.close()
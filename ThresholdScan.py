@@ -0,0 +1,115 @@
+import argparse
+import numpy as np
+import os
+
+from datetime import datetime
+
+# import the APIs
+import api.daq as daq
+
+from api.scan import optimal_thresholds, threshold_scan
+from api.session import Session
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(
+    description='Scans the trigger thresholds of all CRT modules at the same time'
+  )
+  parser.add_argument(
+    '--crt', nargs='*', type=int, default=[],
+    help='CRT modules to scan'
+  )
+  parser.add_argument(
+    '--thresholds', nargs=3, type=int, default=[200, 400, 5],
+    help='First, last and step of the threshold DAC values'
+  )
+  parser.add_argument(
+    '--bias', nargs='?', type=int, default=None,
+    help='Bias setting of the CRT modules (default: the one in the config file)'
+  )
+  parser.add_argument(
+    '--messages', nargs='?', type=int, default=3,
+    help='Number of statistics messages to average the rates over'
+  )
+  parser.add_argument(
+    '--settle', nargs='?', type=float, default=2.,
+    help='Seconds to wait after changing the thresholds'
+  )
+  parser.add_argument(
+    '--target_rate', nargs='?', type=float, default=None,
+    help='Trigger rate to set the thresholds to (default: first plateau of the rate)'
+  )
+  parser.add_argument(
+    '--apply', action='store_true',
+    help='Configure the CRT modules with the optimal thresholds after the scan'
+  )
+  parser.add_argument(
+    '--driver', nargs='?', type=str, default='tcp://localhost:5555',
+    help='Socket to driver              Ex. tcp://localhost:5555'
+  )
+  parser.add_argument(
+    '--stats', nargs='?', type=str, default='tcp://localhost:5557',
+    help='Socket to stats               Ex. tcp://localhost:5557'
+  )
+  parser.add_argument(
+    '--stats_timeout', nargs='?', type=float, default=10.,
+    help='Seconds to wait for the stats of the connected FEBs'
+  )
+  parser.add_argument(
+    '--conf', nargs='?', type=str, default='CONF/SC.txt',
+    help='Path to template config file  Ex. CONF/SC.txt'
+  )
+  parser.add_argument(
+    '--path', nargs='?', type=str, default='data',
+    help='Path to folder where the scan is stored'
+  )
+  args = parser.parse_args()
+
+  session = Session()
+  registry = daq.FEBRegistry(socket=args.stats, session=session).start()
+
+  crts = args.crt or daq.connected_febs(registry=registry, timeout=args.stats_timeout)
+
+  # configure the CRT modules
+  daq.load_config_file(path=args.conf, febs=crts)
+  if args.bias is not None:
+    daq.set_voltages(args.bias, crts)
+
+  first, last, step = args.thresholds
+  thresholds = np.arange(first, last + 1, step)
+
+  crts, rates = threshold_scan(
+    thresholds,
+    crts,
+    registry=registry,
+    messages=args.messages,
+    settle=args.settle,
+    timeout=args.stats_timeout,
+    driver=args.driver,
+    session=session
+  )
+  optimal = optimal_thresholds(thresholds, rates, target_rate=args.target_rate)
+
+  # store the scan
+  os.makedirs(args.path, exist_ok=True)
+  filename = '%s/threshold_scan-%s.npz' % (args.path, str(datetime.now()))
+  np.savez(filename, crts=crts, thresholds=thresholds, rates=rates, optimal=optimal)
+  print("Stored the scan in %s" % filename)
+
+  for crt, threshold in zip(crts, optimal):
+    if np.isnan(threshold):
+      print("CRT Module %d - no optimal threshold found" % crt)
+    else:
+      print("CRT Module %d - optimal threshold %d" % (crt, threshold))
+
+  # the scan restored the configurations of the CRT modules,
+  # only configure them again with the optimal thresholds
+  if args.apply:
+    for crt, threshold in zip(crts, optimal):
+      if not np.isnan(threshold):
+        daq.set_thresholds(int(threshold), crt)
+    daq.configure(crts, driver=args.driver, settle=args.settle, session=session)
+
+  registry.stop()
+  session.close()
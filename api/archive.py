@@ -0,0 +1,302 @@
+import json
+import numpy as np
+import os
+import struct
+import time
+import zlib
+
+## internal variables
+
+# the layout of a histos task, see HISTOGRAMS_t in histos/histograms.h
+_nr_channels = 32
+_nr_bins     = 4096
+_config_size = 143
+
+# every channel of the pedestals and spectra is stored as a separate block
+_nr_blocks = 2 * _nr_channels
+
+# an index entry: mac5, time, chunk, offset and the sizes of the blocks
+_index_format = '<BdHQ' + 'I' * _nr_blocks
+_index_size   = struct.calcsize(_index_format)
+_index_dtype  = np.dtype([
+  ('mac5',   '<u1'),
+  ('time',   '<f8'),
+  ('chunk',  '<u2'),
+  ('offset', '<u8'),
+  ('sizes',  '<u4', (_nr_blocks,)),
+])
+
+# the header of a block: first non empty bin and number of stored bins
+_block_format = '<HH'
+_block_size   = struct.calcsize(_block_format)
+
+
+## internal functions
+
+def _codec(name, level=None):
+  """Returns the compress and decompress functions of a codec.
+  zstd and lz4 are only available if their python packages are installed."""
+
+  if name == 'zlib':
+    level = 6 if level is None else level
+    return (lambda data: zlib.compress(data, level)), zlib.decompress
+
+  if name == 'zstd':
+    import zstandard
+    compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+    decompressor = zstandard.ZstdDecompressor()
+    return compressor.compress, decompressor.decompress
+
+  if name == 'lz4':
+    import lz4.frame
+    level = 0 if level is None else level
+    return (lambda data: lz4.frame.compress(data, compression_level=level)), lz4.frame.decompress
+
+  raise ValueError('Unknown codec %s' % name)
+
+
+def _best_codec():
+  """Returns the fastest available codec"""
+
+  for name, module in (('zstd', 'zstandard'), ('lz4', 'lz4.frame')):
+    try:
+      __import__(module)
+      return name
+    except ImportError:
+      pass
+  return 'zlib'
+
+
+def _task_to_arrays(data):
+  """Unpacks a histos task into numpy arrays, like api.daq.task_to_data"""
+
+  mac5      = data[0]
+  config    = bytes(data[1:1+_config_size])
+  offset    = 1 + _config_size
+  pedestals = np.frombuffer(data, '<u4', _nr_channels * _nr_bins, offset)
+  offset   += 4 * _nr_channels * _nr_bins
+  spectra   = np.frombuffer(data, '<u2', _nr_channels * _nr_bins, offset)
+
+  return (
+    mac5,
+    config,
+    pedestals.reshape(_nr_channels, _nr_bins),
+    spectra.reshape(_nr_channels, _nr_bins)
+  )
+
+
+def _encode_block(values):
+  """Encodes the non empty range of a histogram as differences
+  between consecutive bins, which are mostly small numbers"""
+
+  nonzero = np.flatnonzero(values)
+  if not len(nonzero):
+    return struct.pack(_block_format, 0, 0)
+
+  first = nonzero[0]
+  size = nonzero[-1] - first + 1
+  deltas = np.diff(values[first:first+size].astype('<i8'), prepend=0)
+
+  return struct.pack(_block_format, first, size) + deltas.astype('<i4').tobytes()
+
+
+def _decode_block(data, out):
+  """Decodes a block into the given histogram"""
+
+  first, size = struct.unpack_from(_block_format, data)
+  if size:
+    deltas = np.frombuffer(data, '<i4', size, _block_size)
+    out[first:first+size] = np.cumsum(deltas)
+  return out
+
+
+## api classes
+
+class ArchiveWriter(object):
+  """Appends histos snapshots to a compressed archive.
+
+  The archive is a folder containing a json file describing it, an
+  index with one fixed size entry per snapshot and chunk files holding
+  the snapshots. Every channel of the pedestals and spectra is stored
+  as a separately compressed block, so the reader can decode a single
+  channel without reading the rest."""
+
+  def __init__(self, path, codec=None, level=None, chunk_size=256*1024*1024):
+    os.makedirs(path, exist_ok=True)
+    self.path = path
+    self.chunk_size = chunk_size
+
+    # an existing archive keeps its codec
+    meta = '%s/archive.json' % path
+    if os.path.exists(meta):
+      f = open(meta, 'r')
+      self.codec = json.load(f)['codec']
+      f.close()
+    else:
+      self.codec = codec or _best_codec()
+      f = open(meta, 'w')
+      json.dump({'version': 1, 'codec': self.codec}, f)
+      f.close()
+
+    self._compress, _ = _codec(self.codec, level)
+
+    # continue with the last chunk
+    self._index = open('%s/index' % path, 'ab')
+    self._records = self._index.tell() // _index_size
+    chunks = sorted(name for name in os.listdir(path) if name.endswith('.chunk'))
+    self._chunk_nr = len(chunks) - 1 if chunks else 0
+    self._chunk = open('%s/%04d.chunk' % (path, self._chunk_nr), 'ab')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def write(self, task, timestamp=None):
+    """Appends a raw histos task or an unpacked tuple of
+    (mac5, config, pedestals, spectra) to the archive.
+    Returns the number of the record."""
+
+    if isinstance(task, (bytes, bytearray, memoryview)):
+      mac5, config, pedestals, spectra = _task_to_arrays(task)
+    else:
+      mac5, config, pedestals, spectra = task
+      if isinstance(config, str):
+        config = bytes.fromhex(config)
+
+    timestamp = time.time() if timestamp is None else timestamp
+
+    # start a new chunk once the current one is full
+    if self._chunk.tell() >= self.chunk_size:
+      self._chunk.close()
+      self._chunk_nr += 1
+      self._chunk = open('%s/%04d.chunk' % (self.path, self._chunk_nr), 'ab')
+
+    offset = self._chunk.tell()
+    blocks = [self._compress(_encode_block(np.asarray(values)))
+      for histograms in (pedestals, spectra)
+      for values in histograms
+    ]
+
+    self._chunk.write(config)
+    for block in blocks:
+      self._chunk.write(block)
+    self._chunk.flush()
+
+    # the index entry is written last, so it never points to missing data
+    self._index.write(struct.pack(
+      _index_format,
+      mac5,
+      timestamp,
+      self._chunk_nr,
+      offset,
+      *[len(block) for block in blocks]
+    ))
+    self._index.flush()
+
+    self._records += 1
+    return self._records - 1
+
+  def close(self):
+    self._chunk.close()
+    self._index.close()
+
+
+class ArchiveReader(object):
+  """Reads snapshots or single channel series from an archive"""
+
+  def __init__(self, path):
+    self.path = path
+
+    f = open('%s/archive.json' % path, 'r')
+    self.codec = json.load(f)['codec']
+    f.close()
+    _, self._decompress = _codec(self.codec)
+
+    # the index is small, keep it in memory
+    self.index = np.fromfile('%s/index' % path, dtype=_index_dtype)
+
+    # the offsets of the blocks within the chunks
+    self._offsets = self.index['offset'][:, None] + _config_size + np.concatenate((
+      np.zeros((len(self.index), 1), dtype='<u8'),
+      np.cumsum(self.index['sizes'], axis=1)[:, :-1].astype('<u8')
+    ), axis=1)
+
+    self._chunks = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __len__(self):
+    return len(self.index)
+
+  def _read(self, chunk, offset, size):
+    if chunk not in self._chunks:
+      self._chunks[chunk] = open('%s/%04d.chunk' % (self.path, chunk), 'rb')
+    f = self._chunks[chunk]
+    f.seek(offset)
+    return f.read(size)
+
+  def _block(self, record, block, dtype):
+    data = self._decompress(self._read(
+      int(self.index['chunk'][record]),
+      int(self._offsets[record, block]),
+      int(self.index['sizes'][record, block])
+    ))
+    return _decode_block(data, np.zeros(_nr_bins, dtype=dtype))
+
+  def crts(self):
+    """Returns the CRT modules with snapshots in the archive"""
+
+    return sorted(np.unique(self.index['mac5']).tolist())
+
+  def records(self, crt=None):
+    """Returns the numbers of the records of the given CRT module,
+    or of all the records if no CRT module is given"""
+
+    if crt is None:
+      return np.arange(len(self.index))
+    return np.flatnonzero(self.index['mac5'] == crt)
+
+  def read(self, record):
+    """Returns a snapshot as (mac5, config, pedestals, spectra),
+    in the same format as api.daq.task_to_data"""
+
+    entry = self.index[record]
+    config = self._read(int(entry['chunk']), int(entry['offset']), _config_size)
+
+    pedestals = [tuple(self._block(record, channel, '<u4').tolist())
+      for channel in range(_nr_channels)
+    ]
+    spectra = [tuple(self._block(record, _nr_channels + channel, '<u2').tolist())
+      for channel in range(_nr_channels)
+    ]
+
+    return int(entry['mac5']), config.hex(), pedestals, spectra
+
+  def series(self, crt, channel, kind='spectra'):
+    """Returns the histograms of a channel of a CRT module for
+    every snapshot as a numpy array of shape (snapshots, bins)"""
+
+    if kind == 'spectra':
+      block, dtype = _nr_channels + channel, '<u2'
+    elif kind == 'pedestals':
+      block, dtype = channel, '<u4'
+    else:
+      raise ValueError('Unknown kind of histogram %s' % kind)
+
+    records = self.records(crt)
+    series = np.zeros((len(records), _nr_bins), dtype=dtype)
+    for nr, record in enumerate(records):
+      series[nr] = self._block(record, block, dtype)
+
+    return series
+
+  def close(self):
+    for f in self._chunks.values():
+      f.close()
+    self._chunks = {}
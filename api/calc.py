@@ -1,15 +1,23 @@
-from plotly.offline import iplot
 from random         import sample
-from scipy.optimize import curve_fit
 
-import plotly.graph_objs as go
 import numpy             as np
 import glob
+import itertools
 import json
+import os
 import pickle
 import sys
 import zmq
 
+from . import profiling
+from .archive import ArchiveReader
+from .session import default_session
+
+## internal variables
+
+# counts the calls to the fitter
+_calls = itertools.count()
+
 ## internal functions
 
 def _gauss(x, A, μ, σ):
@@ -18,6 +26,9 @@ def _gauss(x, A, μ, σ):
 def _fit_gaussian(histogram, A=0, μ=0, σ=0, visuals=False):
   # histogram is a dict of {binnr: value}
 
+  # scipy is slow to import, only load it when it's needed
+  from scipy.optimize import curve_fit
+
   try:
     xdata = [x for x in histogram if int(μ-3*σ) <= x <= int(μ+3*σ)]
     ydata = [histogram[x] for x in xdata]
@@ -31,26 +42,10 @@ def _fit_gaussian(histogram, A=0, μ=0, σ=0, visuals=False):
       p0=[A, μ, σ]
     )
 
-    x_range = np.linspace(min(xdata), max(xdata), 100)
-    y_gauss = _gauss(x_range, params[0], params[1], params[2])
-
     if visuals:
-      iplot(go.Figure(
-        data=[go.Bar(
-          x=xdata,
-          y=ydata,
-          name='data'
-        ), go.Scatter(
-          x=x_range,
-          y=y_gauss,
-          name='μ=%.2f (%.2f)' % (params[1], pcov[1][1])
-        )],
-        layout=go.Layout(
-          title='Fitted gaussian',
-          xaxis={'title':'ADC Counts / Bin Nr'},
-          yaxis={'title':'Nr Events'}
-        )
-      ))
+      # plotly is slow to import, only load it when it's needed
+      from . import diagnostics
+      diagnostics.plot_fit(xdata, ydata, params, pcov)
 
     return (params[0], params[1], params[2]), pcov
 
@@ -59,6 +54,109 @@ def _fit_gaussian(histogram, A=0, μ=0, σ=0, visuals=False):
     raise
 
 
+def _fit_gain(distances, target=.1):
+  """Returns the gain fitted to the histogram of the distances between
+  peaks, or None if its relative uncertainty is not below target"""
+
+  # Build a histogram using the distances
+  ydata, edges = np.histogram(
+      [d for d, _ in distances],
+      bins=50,
+      range=[20, 120]
+  )
+  xdata = (edges[:-1] + edges[1:]) / 2
+
+  pos = ydata.argmax()
+
+  (A, mu, sigma), pcov = _fit_gaussian(
+    dict(zip(xdata, ydata)),
+    max(ydata),
+    xdata[pos],
+    8 # TODO: don't like this hard coded stuff
+  )
+
+  if (np.sqrt(pcov[1][1]) / mu)**2 < target**2:
+    return (A, mu, sigma), pcov
+
+
+def _aggregate(spectra, nr=10, window=(300, 1000)):
+  """Returns the sum of nr randomly chosen spectra, cut to the window.
+  If there are less spectra, all of them are summed."""
+
+  return [sum(_) for _ in zip(*sample(spectra, min(nr, len(spectra))))][window[0]:window[1]]
+
+
+def _task_message(key, spectrum):
+  """Returns the task for the fitter, which needs a histogram { binnr:value, ... }"""
+
+  hist = dict(zip(range(len(spectrum)), spectrum))
+  return json.dumps({
+    'key':      key,
+    'spectrum': hist
+  })
+
+
+def _parse_answer(answer):
+  """Returns the decoded key and the response of the fitter.
+  The response is a json structure containing the key, peak positions
+  and computed distances, or the key and an error."""
+
+  if answer == 'ERR':
+    return None, None
+
+  answer = json.loads(str(answer))
+  return json.loads(answer['key']), answer
+
+
+def _new_call():
+  """Returns an id to recognize the responses to a call"""
+
+  return '%x-%x' % (os.getpid(), next(_calls))
+
+
+def _joint_design(theta, x, bias, peaks, background=3):
+  """Returns the design matrices of the joint fit of the spectra of every
+  channel at every bias setting, of shape (channels, bias, bins, columns).
+  The columns are the photo electron peaks and a polynomial background."""
+
+  slope, offset, pedestal, noise, spread = theta.T
+
+  # the gain is linear in the bias, the pedestal and the noise are shared
+  gains = slope[:, None] * bias[None, :] + offset[:, None]
+  centers = pedestal[:, None, None] + peaks[None, None, :] * gains[:, :, None]
+  widths = noise[:, None]**2 + peaks[None, :] * spread[:, None]**2
+
+  design = np.exp(
+    -(x[None, None, :, None] - centers[:, :, None, :])**2 / (2 * widths[:, None, None, :])
+  )
+
+  polynomial = np.polynomial.legendre.legvander(np.linspace(-1, 1, len(x)), background)
+  polynomial = np.broadcast_to(polynomial, design.shape[:2] + polynomial.shape)
+
+  return np.concatenate([design, polynomial], axis=3)
+
+
+def _joint_residuals(theta, x, bias, peaks, spectra, weights, background=3):
+  """Returns the weighted residuals of the joint fit, with the amplitudes
+  of the peaks and the background solved by linear least squares"""
+
+  design = _joint_design(theta, x, bias, peaks, background) * weights[..., None]
+  target = spectra * weights
+
+  transposed = np.swapaxes(design, 2, 3)
+  normal = transposed @ design
+  projected = transposed @ target[..., None]
+
+  # peaks outside the window have no contribution, keep the system regular
+  ridge = 1e-10 * np.trace(normal, axis1=2, axis2=3)[..., None, None] + 1e-12
+  normal += ridge * np.eye(normal.shape[-1])
+
+  amplitudes = np.linalg.solve(normal, projected)
+  residuals = target - (design @ amplitudes)[..., 0]
+
+  return residuals.reshape(len(theta), -1)
+
+
 def _rebin(histogram, bin_size=1, visuals=False):
   # split histogram into values and bins
   values = list(histogram.values())
@@ -89,29 +187,78 @@ def get_histograms(template='*.histos'):
   return histograms
 
 
+def get_archived_histograms(path, crts=[]):
+  """Returns the histograms of an archive written by api.daq.acquire,
+  in the same format as get_histograms.
+  If the list of crts is empty, return the histograms of all the crts."""
+
+  # We need a list of crts, if only one is given,
+  # generate a list with a single element
+  if type(crts) == int:
+    crts = [crts]
+
+  histograms = {}
+  with ArchiveReader(path) as archive:
+    for crt in (crts or archive.crts()):
+      histograms[crt] = [archive.read(record)[1:] for record in archive.records(crt)]
+  return histograms
+
+
+def iter_histograms(catalog, crts=[], bias=None, run=None, stage=None, since=None):
+  """Yields the snapshots recorded in the catalog matching the given
+  crts, bias setting, run and stage (acquired since the given time) as
+  (mac5, config, pedestals, spectra).
+  The snapshots are only loaded when they are consumed."""
+
+  archives = {}
+  try:
+    for crt, _, _, _, _, _, location, record in catalog.query(
+      crts=crts, bias=bias, run=run, stage=stage, since=since
+    ):
+
+      with profiling.region('calc.load'):
+
+        # the snapshot is a record of an archive
+        if record is not None:
+          if location not in archives:
+            archives[location] = ArchiveReader(location)
+          snapshot = archives[location].read(record)
+
+        else:
+          file = open(location, 'rb')
+          snapshot = pickle.load(file)
+          file.close()
+
+      yield snapshot
+
+  finally:
+    for archive in archives.values():
+      archive.close()
+
+
 def get_peaks_and_distances(
   histograms,
   sipms=range(32),
   output_socket='tcp://localhost:7000',
-  input_socket='tcp://localhost:8000'
+  input_socket='tcp://localhost:8000',
+  session=None
 ):
   """Returns the found peak positions and
   computed distances for the given list
   of SiPMs using the peak finder / fitter"""
 
   # connects to the peak finder and fitter
-  context = zmq.Context()
-
-  pusher = context.socket(zmq.PUSH)
-  pusher.connect(output_socket)
-
-  puller = context.socket(zmq.PULL)
-  puller.connect(input_socket)
+  session = session or default_session()
+  pusher  = session.socket(zmq.PUSH, output_socket)
+  puller  = session.socket(zmq.PULL, input_socket)
 
   # stores the results of the peak finder and fitter
   distances = {}
   peaks     = {}
 
+  # responses to other calls are ignored
+  call = _new_call()
+
   # compute the gain for every channel
   for sipm in sipms:
     
@@ -127,48 +274,39 @@ def get_peaks_and_distances(
     # be combined into one histogram.
     # let's take 15 aggregated histograms of 50k events
     # and cut out the relevant part of it
-    aggregated = [[sum(_) for _ in zip(*sample(spectra, 10))][300:1000]
-      for i in range(15)
-    ]
+    with profiling.region('calc.aggregate'):
+      aggregated = [_aggregate(spectra) for i in range(15)]
 
     # generate a key to recognize the results
     # (improve this if several subprocesses need to communicate with the fitter,
     # at the same time in order to know which task belongs to which subprocess.
     # use a subscribtion socket using the key as filter instead of a puller)
-    key = json.dumps({'sipm': sipm})
+    key = json.dumps({'sipm': sipm, 'call': call})
 
     # send the tasks to the fitter
-    for spectrum in aggregated:
-
-      # the fitter needs a histogram { binnr:value, ... }
-      hist = dict(zip(range(len(spectrum)), spectrum))
-      message = json.dumps({
-        'key':      key,
-        'spectrum': hist
-      })
-      pusher.send_string(message)
-      sent += 1
+    with profiling.region('calc.encode'):
+      for spectrum in aggregated:
+        pusher.send_string(_task_message(key, spectrum))
+        sent += 1
 
     # get the distances between the peaks
     # from the fitter's result / response
     errors = 0
-    for i in range(sent):
+    while received + errors < sent:
 
-      answer = puller.recv_string()
+      with profiling.region('calc.fitter'):
+        key, answer = _parse_answer(puller.recv_string())
 
-      # TODO: this can be improved:
-      # the error should be given
-      # by an error key in the response
-      if answer == 'ERR':
+      # an error without key can't be attributed,
+      # older fitters respond with 'ERR' only
+      if key is None:
         errors += 1
         continue
 
-      # the response of the fitter is a json
-      # structure containing the key,
-      # peak positions and computed distances
-      answer = json.loads(str(answer))
+      # a late response to another call
+      if key.get('call') != call:
+        continue
 
-      key = json.loads(answer['key'])
       _s = key['sipm']
 
       if 'distances' not in answer:
@@ -187,12 +325,10 @@ def get_peaks_and_distances(
     
     print('  SiPM %02d - Sent / Received / Errors: %d / %d / %d' % (sipm, sent, received, errors))
 
-  # TODO: close the context or use the decorator given by pyzmq
-  
   return peaks, distances
 
 
-def get_gains(distances, sipms=range(32)):
+def get_gains(distances, sipms=range(32), target=.1, min_distances=100):
   """Returns the gains computed using the
   list of computed distances between peaks"""
 
@@ -209,32 +345,17 @@ def get_gains(distances, sipms=range(32)):
     # at least. Something goes totally wrong if less than 100
     # distances are collected.
     if sipm in distances:
-      if len(distances[sipm]) < 100:
+      if len(distances[sipm]) < min_distances:
         errors += 1
         continue
 
-      # Build a histogram using the distances
-      ydata, edges = np.histogram(
-          [d for d, _ in distances[sipm]],
-          bins=50,
-          range=[20, 120]
-      )
-      xdata = (edges[:-1] + edges[1:]) / 2
-
-      pos = ydata.argmax()
-
-      res = []
       try:
-        (A, mu, sigma), pcov = _fit_gaussian(
-          dict(zip(xdata, ydata)),
-          max(ydata),
-          xdata[pos],
-          8 # TODO: don't like this hard coded stuff
-        )
+        with profiling.region('calc.gains'):
+          gain = _fit_gain(distances[sipm], target)
 
-        # store the gain if its uncertainty is less than 10%
-        if (np.sqrt(pcov[1][1]) / mu)**2 < .1**2:
-          gains[sipm] = (A, mu, sigma), pcov
+        # store the gain if its uncertainty is less than the target
+        if gain is not None:
+          gains[sipm] = gain
 
       except RuntimeError as e:
         errors += 1
@@ -242,3 +363,316 @@ def get_gains(distances, sipms=range(32)):
   print('  Computed %d gains got %d errors' % (len(gains), errors))
 
   return gains
+
+
+def stream_gains(
+  histograms,
+  sipms=range(32),
+  target=.1,
+  min_distances=100,
+  nr_tasks=15,
+  in_flight=4,
+  timeout=60.,
+  output_socket='tcp://localhost:7000',
+  input_socket='tcp://localhost:8000',
+  session=None
+):
+  """Returns the found peak positions, computed distances and gains
+  for the given list of SiPMs, estimating the gains while the peak
+  finder / fitter responds.
+
+  The tasks of every SiPM are sent progressively, at most in_flight at
+  a time and nr_tasks in total. As soon as the relative uncertainty of
+  a SiPM's gain is below target, its gain is final and its remaining
+  tasks are cancelled: unsent tasks are dropped and the responses to
+  the sent ones are ignored. If timeout seconds pass without response,
+  the SiPMs still waiting fail, ex. when tasks were lost or answered by
+  an older fitter with an error without key. Without timeout, wait
+  for the responses forever."""
+
+  # connects to the peak finder and fitter
+  session = session or default_session()
+  pusher  = session.socket(zmq.PUSH, output_socket)
+  puller  = session.socket(zmq.PULL, input_socket)
+
+  # responses to other calls are ignored
+  call = _new_call()
+
+  sipms     = list(sipms)
+  spectra   = {sipm: [ss[sipm] for config, pp, ss in histograms] for sipm in sipms}
+  keys      = {sipm: json.dumps({'sipm': sipm, 'call': call}) for sipm in sipms}
+  sent      = {sipm: 0 for sipm in sipms}
+  pending   = {sipm: 0 for sipm in sipms}
+  errors    = {sipm: 0 for sipm in sipms}
+  distances = {}
+  peaks     = {}
+  gains     = {}
+  done      = set()
+
+  def send(sipm):
+    while pending[sipm] < in_flight and sent[sipm] < nr_tasks:
+      with profiling.region('calc.aggregate'):
+        spectrum = _aggregate(spectra[sipm])
+      with profiling.region('calc.encode'):
+        pusher.send_string(_task_message(keys[sipm], spectrum))
+      sent[sipm] += 1
+      pending[sipm] += 1
+
+  def finish(sipm, gain=None):
+    done.add(sipm)
+    if gain is not None:
+      gains[sipm] = gain
+    print('  SiPM %02d - Sent / Received / Errors / Cancelled: %d / %d / %d / %d' % (
+      sipm,
+      sent[sipm],
+      sent[sipm] - pending[sipm] - errors[sipm],
+      errors[sipm],
+      nr_tasks - sent[sipm] + pending[sipm]
+    ))
+
+  # start with the first tasks of every SiPM to keep the fitters busy
+  for sipm in sipms:
+    send(sipm)
+
+  while len(done) < len(sipms):
+
+    with profiling.region('calc.fitter'):
+      responded = puller.poll(None if timeout is None else int(1000 * timeout), zmq.POLLIN)
+      if responded:
+        key, answer = _parse_answer(puller.recv_string())
+
+    if not responded:
+      print('  No response from the fitter within %d s' % timeout)
+      for sipm in sipms:
+        if sipm not in done:
+          finish(sipm)
+      break
+
+    # an error without key can't be attributed
+    if key is None or key.get('call') != call:
+      continue
+
+    sipm = key['sipm']
+    if sipm not in pending or sipm in done:
+      continue
+    pending[sipm] -= 1
+
+    if 'distances' not in answer:
+      errors[sipm] += 1
+    else:
+      distances.setdefault(sipm, []).extend(answer['distances'])
+      peaks.setdefault(sipm, []).extend(answer['peaks'])
+
+    # update the estimate of the gain
+    gain = None
+    if len(distances.get(sipm, [])) >= min_distances:
+      try:
+        with profiling.region('calc.gains'):
+          gain = _fit_gain(distances[sipm], target)
+      except RuntimeError:
+        pass
+
+    if gain is not None:
+      finish(sipm, gain)
+    elif sent[sipm] < nr_tasks:
+      send(sipm)
+    elif not pending[sipm]:
+      finish(sipm)
+
+  print('  Computed %d gains got %d errors' % (len(gains), len(sipms) - len(gains)))
+
+  return peaks, distances, gains
+
+
+def estimate_gains(spectra, window=(300, 1000), gain_range=(20, 120)):
+  """Estimates the gains of the given spectra from the spacing of
+  their peaks, without the peak finder / fitter.
+
+  The smooth background is removed and the gain is taken as the lag
+  of the maximum of the autocorrelation within the gain range. Works
+  on all the spectra at once, returns the gains and the normalized
+  autocorrelation at the gain, which is a measure of its quality."""
+
+  spectra = np.atleast_2d(np.asarray(spectra, dtype=float))
+  spectra = spectra[:, window[0]:window[1]]
+  size = spectra.shape[1]
+
+  # remove the background by subtracting the moving average
+  # over the largest expected distance between two peaks
+  width = gain_range[1]
+  padded = np.pad(spectra, ((0, 0), (width // 2, width - width // 2)), mode='edge')
+  cumulated = np.cumsum(padded, axis=1)
+  background = (cumulated[:, width:] - cumulated[:, :-width])[:, :size] / width
+  residuals = spectra - background
+
+  # the autocorrelation using the fft, zero padded to avoid wrapping
+  transformed = np.fft.rfft(residuals, 2 * size, axis=1)
+  correlation = np.fft.irfft(transformed * np.conj(transformed), 2 * size, axis=1)[:, :size]
+
+  # the lag with the highest correlation within the gain range
+  lags = np.arange(gain_range[0], min(gain_range[1], size - 2) + 1)
+  pos = correlation[:, lags].argmax(axis=1)
+
+  # refine the position with a parabola through the neighbouring lags
+  rows = np.arange(len(spectra))
+  left, center, right = (correlation[rows, lags[pos] + offset] for offset in (-1, 0, 1))
+  curvature = left - 2 * center + right
+  with np.errstate(divide='ignore', invalid='ignore'):
+    shift = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0.)
+    quality = np.where(correlation[:, 0] > 0, center / correlation[:, 0], 0.)
+
+  return lags[pos] + np.clip(shift, -.5, .5), quality
+
+
+
+def fit_joint(
+  spectra,
+  pedestals,
+  bias_settings,
+  window=(300, 1000),
+  gain_range=(20, 120),
+  background=3,
+  max_iterations=100,
+  tolerance=1e-6,
+  min_quality=.5
+):
+  """Fits the spectra of every channel at all the bias settings at once,
+  with the gain linear in the bias and the pedestal and noise shared by
+  all the bias settings, ex. to use shorter acquisitions per bias setting.
+
+  The spectra are given as array of shape (channels, bias settings, bins),
+  the pedestals of the same shape or summed over the bias settings. The
+  n-th photo electron peak is a gaussian at pedestal + n * gain with a
+  variance of noise**2 + n * spread**2 and a free amplitude, on top of a
+  polynomial background. The amplitudes and the background are solved
+  linearly, the remaining parameters are fitted with Levenberg-Marquardt
+  for all the channels at the same time.
+
+  Returns the parameters (slope, offset, pedestal, noise, spread) of every
+  channel, where gain = slope * bias + offset, their covariances and the
+  quality of the fits, the fraction of the chi squared of the background
+  alone explained by the peaks. The parameters of channels which can't be
+  fitted or with a quality below min_quality are NaN. Raises a ValueError
+  with less than two distinct bias settings."""
+
+  # the slope of the gain needs at least two bias settings
+  if len(set(np.asarray(bias_settings).tolist())) < 2:
+    raise ValueError('A joint fit needs at least two distinct bias settings')
+
+  spectra = np.asarray(spectra, dtype=float)
+  pedestals = np.asarray(pedestals, dtype=float)
+  if pedestals.ndim == 3:
+    pedestals = pedestals.sum(axis=1)
+  channels, settings, size = spectra.shape
+
+  # the bias is centered to decorrelate the slope and the offset
+  bias_settings = np.asarray(bias_settings, dtype=float)
+  center = bias_settings.mean()
+  bias = bias_settings - center
+
+  # the gains at every bias setting give the initial slope and offset
+  estimated, _ = estimate_gains(spectra.reshape(channels * settings, size), window, gain_range)
+  estimated = estimated.reshape(channels, settings)
+  offset = estimated.mean(axis=1)
+  slope = (estimated - offset[:, None]) @ bias / max((bias**2).sum(), 1e-12)
+
+  # the pedestal and the noise from the moments of the pedestal peak
+  bins = np.arange(pedestals.shape[1])
+  near = np.abs(bins[None, :] - pedestals.argmax(axis=1)[:, None]) <= gain_range[0] // 2
+  counts = np.where(near, pedestals, 0)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    pedestal = (counts * bins).sum(axis=1) / counts.sum(axis=1)
+    noise = np.sqrt((counts * (bins[None, :] - pedestal[:, None])**2).sum(axis=1) / counts.sum(axis=1))
+
+  theta = np.stack([slope, offset, pedestal, np.maximum(noise, 1.), np.maximum(.05 * offset, 1.)], axis=1)
+
+  x = np.arange(window[0], window[1], dtype=float)
+  y = spectra[:, :, window[0]:window[1]]
+  weights = 1 / np.sqrt(y + 1)
+
+  gains = theta[:, :1] * bias[None, :] + theta[:, 1:2]
+  valid = np.isfinite(theta).all(axis=1) & (gains > 0).all(axis=1) & (y.sum(axis=(1, 2)) > 0)
+
+  params = np.full((channels, 5), np.nan)
+  covariance = np.full((channels, 5, 5), np.nan)
+  quality = np.zeros(channels)
+  if not valid.any():
+    return params, covariance, quality
+
+  theta, y, weights, gains = theta[valid], y[valid], weights[valid], gains[valid]
+
+  # the peaks which can show within the window
+  first = max(int(np.floor(((window[0] - theta[:, 2:3]) / gains).min() * .8)), 1)
+  last = int(np.ceil(((window[1] - theta[:, 2:3]) / gains).max() * 1.2)) + 1
+  peaks = np.arange(first, last + 1, dtype=float)
+
+  def residuals(theta):
+    return _joint_residuals(theta, x, bias, peaks, y, weights, background)
+
+  # batched Levenberg-Marquardt with a numerical jacobian
+  current = residuals(theta)
+  cost = (current**2).sum(axis=1)
+  damping = np.full(len(theta), 1e-3)
+  active = np.ones(len(theta), dtype=bool)
+
+  for iteration in range(max_iterations):
+    steps = 1e-4 * (np.abs(theta) + 1)
+    jacobian = np.stack([
+      (residuals(theta + np.eye(5)[p] * steps[:, p:p+1]) - current) / steps[:, p:p+1]
+      for p in range(5)
+    ], axis=2)
+
+    normal = np.einsum('cmp,cmq->cpq', jacobian, jacobian)
+    gradient = np.einsum('cmp,cm->cp', jacobian, current)
+    diagonal = np.einsum('cpp->cp', normal)
+
+    damped = normal + damping[:, None, None] * (diagonal[:, :, None] * np.eye(5))
+    trial = theta - np.linalg.solve(damped, gradient[..., None])[..., 0]
+    trial = np.where(active[:, None], trial, theta)
+
+    with np.errstate(invalid='ignore', over='ignore'):
+      _current = residuals(trial)
+      _cost = (_current**2).sum(axis=1)
+    better = active & np.isfinite(_cost) & (_cost < cost)
+
+    # the channels are done as soon as their cost doesn't improve anymore
+    step = trial - theta
+    predicted = np.einsum('cp,cpq,cq->c', step, normal, step)
+    converged = (better & (cost - _cost < tolerance * cost)) | (predicted < tolerance * cost)
+    active &= ~converged
+
+    theta = np.where(better[:, None], trial, theta)
+    current = np.where(better[:, None], _current, current)
+    cost = np.where(better, _cost, cost)
+    damping = np.where(better, damping / 3, damping * 3)
+
+    if not active.any():
+      break
+
+  # the covariance, scaled by the reduced chi squared
+  dof = current.shape[1] - 5 - settings * (len(peaks) + background + 1)
+  with np.errstate(invalid='ignore'):
+    _covariance = np.linalg.pinv(normal) * np.maximum(cost / max(dof, 1), 1)[:, None, None]
+
+  # back to the offset at zero bias
+  transform = np.eye(5)
+  transform[1, 0] = -center
+  theta[:, 1] -= center * theta[:, 0]
+  theta[:, 3:] = np.abs(theta[:, 3:])
+  _covariance = transform @ _covariance @ transform.T
+
+  # the peaks have to explain the spectra, not just the noise
+  _cost = (_joint_residuals(theta, x, bias, np.zeros(0), y, weights, background)**2).sum(axis=1)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    quality[valid] = np.nan_to_num(1 - cost / _cost)
+
+  # the gains have to stay within the gain range
+  gains = theta[:, :1] * bias_settings[None, :] + theta[:, 1:2]
+  inside = ((gains >= gain_range[0]) & (gains <= gain_range[1])).all(axis=1)
+  inside &= quality[valid] >= min_quality
+
+  indices = np.flatnonzero(valid)[inside]
+  params[indices] = theta[inside]
+  covariance[indices] = _covariance[inside]
+
+  return params, covariance, quality
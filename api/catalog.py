@@ -0,0 +1,122 @@
+import hashlib
+import os
+import sqlite3
+
+## internal variables
+
+_schema = """
+CREATE TABLE IF NOT EXISTS snapshots (
+  id       INTEGER PRIMARY KEY,
+  crt      INTEGER NOT NULL,
+  bias     INTEGER,
+  run      TEXT,
+  stage    TEXT,
+  time     REAL NOT NULL,
+  config   TEXT NOT NULL,
+  location TEXT NOT NULL,
+  record   INTEGER
+);
+CREATE INDEX IF NOT EXISTS snapshots_crt_bias ON snapshots (crt, bias);
+CREATE INDEX IF NOT EXISTS snapshots_run_crt ON snapshots (run, crt);
+"""
+
+# the columns added to the snapshots of older catalogs
+_migrations = (
+  ('stage', 'ALTER TABLE snapshots ADD COLUMN stage TEXT'),
+)
+
+
+## api functions
+
+def config_hash(config):
+  """Returns a short hash of a configuration hex string or bytes"""
+
+  if isinstance(config, str):
+    config = bytes.fromhex(config)
+  return hashlib.sha1(config).hexdigest()[:16]
+
+
+## api classes
+
+class Catalog(object):
+  """Index of the acquired snapshots, stored as SQLite database in the
+  data folder. Every snapshot is recorded with its CRT module, bias
+  setting, run, stage of the run, time, configuration hash and location,
+  which is either a pickled file or a record of an archive, relative to
+  the data folder. Runs are unique, ex. the runs of the results database,
+  while the stages repeat in every run, ex. 'bias_180' or 'evaluation'."""
+
+  def __init__(self, path='data', filename='catalog.sqlite'):
+    os.makedirs(path, exist_ok=True)
+    self.path = path
+    self.connection = sqlite3.connect('%s/%s' % (path, filename))
+    self.connection.executescript(_schema)
+
+    columns = [row[1] for row in self.connection.execute('PRAGMA table_info(snapshots)')]
+    for column, statement in _migrations:
+      if column not in columns:
+        self.connection.execute(statement)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def add(self, crt, time, config, location, record=None, bias=None, run=None, stage=None):
+    """Records a snapshot stored in a pickled file or in a record of an archive.
+    Call commit to store the added snapshots."""
+
+    self.connection.execute(
+      'INSERT INTO snapshots (crt, bias, run, stage, time, config, location, record) '
+      'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+      (crt, bias, run, stage, time, config_hash(config), os.path.relpath(location, self.path), record)
+    )
+
+  def commit(self):
+    self.connection.commit()
+
+  def query(self, crts=[], bias=None, run=None, stage=None, config=None, since=None, until=None):
+    """Returns the snapshots matching the given criteria, ordered by time,
+    as a list of (crt, bias, run, stage, time, config, location, record).
+    If the list of crts is empty, return the snapshots of all the crts."""
+
+    # We need a list of crts, if only one is given,
+    # generate a list with a single element
+    if type(crts) == int:
+      crts = [crts]
+
+    conditions = []
+    values = []
+    if len(crts):
+      conditions.append('crt IN (%s)' % ', '.join('?' * len(crts)))
+      values += list(crts)
+    for column, value in (('bias', bias), ('run', run), ('stage', stage), ('config', config)):
+      if value is not None:
+        conditions.append('%s = ?' % column)
+        values.append(value)
+    if since is not None:
+      conditions.append('time >= ?')
+      values.append(since)
+    if until is not None:
+      conditions.append('time < ?')
+      values.append(until)
+
+    statement = 'SELECT crt, bias, run, stage, time, config, location, record FROM snapshots'
+    if conditions:
+      statement += ' WHERE ' + ' AND '.join(conditions)
+    statement += ' ORDER BY time, id'
+
+    return [(crt, bias, run, stage, time, config, os.path.join(self.path, location), record)
+      for crt, bias, run, stage, time, config, location, record
+      in self.connection.execute(statement, values)
+    ]
+
+  def crts(self, bias=None, run=None, stage=None):
+    """Returns the CRT modules with snapshots for the given bias, run or stage"""
+
+    return sorted(set(crt for crt, *_ in self.query(bias=bias, run=run, stage=stage)))
+
+  def close(self):
+    self.connection.commit()
+    self.connection.close()
@@ -1,17 +1,42 @@
+import multiprocessing
 import pickle
+import re
 import struct
 import subprocess
+import threading
 import time
 import zmq
 
 from datetime import datetime
 
+from . import profiling
+from .archive import ArchiveWriter
+from .session import default_session
+
 
 ## internal variables
 
 # keeps the configuration hex strings for the febs
 _configs = {}
 
+# matches the 'Key: value' or 'key=value' pairs of a feb's stats entry
+_stats_pattern = re.compile(r'(\w+)\s*[:=]\s*([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)')
+
+# maps the names used by the driver to the fields of the feb's status
+_stats_fields = {
+    'connected':  'connected',
+    'configured': 'configured',
+    'conf':       'configured',
+    'biason':     'biason',
+    'bias':       'biason',
+    'error':      'error',
+    'evtperpoll': 'evtperpoll',
+    'lostcpu':    'lostcpu',
+    'lostfpga':   'lostfpga',
+    'evtrate':    'evtrate',
+    'rate':       'evtrate',
+}
+
 
 ## internal functions
 
@@ -83,38 +108,275 @@ def _encrypt(bitstring):
     return encrypted
 
 
-# API functions
+def _parse_stats(message):
+    """Parses a message of the driver's statistics publisher
+    into a dict of {serial number: status} of the connected febs"""
 
-def connected_febs(socket="tcp://localhost:5557"):
-    """Returns a list containing the serial numbers of the connected febs"""
+    message_parts = message.split('\n')[1:-1]
+    feb_entries = [entry for entry in message_parts if 'FEB' in entry]
 
-    # zeromq connections
-    context = zmq.Context()
+    febs = {}
+    for entry in feb_entries:
+        mac_address = entry.split(' ')[1]
+
+        # the status of the feb, see FEB_STATUS_t in histos/febevt.h
+        status = {
+            'mac': mac_address,
+            'connected': 1,
+            'configured': 0,
+            'biason': 0,
+            'error': 0,
+            'evtperpoll': 0,
+            'lostcpu': 0,
+            'lostfpga': 0,
+            'evtrate': 0.0,
+        }
+
+        # the remaining part of the entry holds the counters and flags
+        rest = entry.split(mac_address, 1)[1]
+        for name, value in _stats_pattern.findall(rest):
+            field = _stats_fields.get(name.lower())
+            if field is not None:
+                status[field] = float(value) if field == 'evtrate' else int(float(value))
+
+        febs[int(mac_address.split(':')[-1], 16)] = status
 
-    # statistics publisher
-    statistics = context.socket(zmq.SUB)
-    statistics.connect(socket)
-    statistics.setsockopt(zmq.SUBSCRIBE, b"")
+    return febs
 
-    # get the list of connected febs
-    message = statistics.recv_string()
-    message_parts = message.split('\n')[1:-1]
-    feb_entries = [entry for entry in message_parts if 'FEB' in entry]
-    mac_addresses = [feb.split(' ')[1] for feb in feb_entries]
 
-    # the connected feb's serial numbers
-    febs = [int(address.split(':')[-1], 16) for address in mac_addresses]
+def _send_command(driver, command, feb, payload=b'', timeout=10.):
+    """Sends a command to the driver and waits for its reply"""
 
-    # close the context and the socket
-    statistics.close()
-    context.term()
+    # the driver expects the command padded to 8 bytes followed by the feb's mac5
+    driver.send(command.encode().ljust(8, b'\0') + bytes([feb]) + payload)
+    if not driver.poll(int(1000 * timeout), zmq.POLLIN):
+        raise TimeoutError('No reply from the driver to %s' % command)
+    return driver.recv()
+
+
+def _register(febs):
+    """Adds the given febs to the known configurations"""
 
-    # store the febs
     for feb in febs:
         if feb not in _configs:
             _configs[feb] = None
 
-    # TODO: close the context
+
+# API classes
+
+class FEBRegistry(object):
+    """Keeps a live table of the connected febs and their status.
+
+    The registry subscribes to the driver's statistics publisher
+    on a background thread and answers queries from the latest
+    received message, without a round trip to the driver."""
+
+    def __init__(self, socket="tcp://localhost:5557", session=None, poll_interval=100):
+        self.socket = socket
+        self.poll_interval = poll_interval
+
+        # the subscriber runs on its own thread, so it only shares
+        # the session's context and not its pooled sockets
+        self._context = session.context if session is not None else None
+        self._own_context = session is None
+        self._lock = threading.Lock()
+        self._updated = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._thread = None
+
+        # the live table of {serial number: status}
+        self._febs = {}
+        self._messages = 0
+        self._last_update = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """Starts the background subscriber if it is not running yet"""
+
+        if self._thread is not None and self._thread.is_alive():
+            return self
+
+        if self._context is None:
+            self._context = zmq.Context()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='FEBRegistry', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stops the background subscriber and releases its resources"""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+        if self._own_context and self._context is not None:
+            self._context.term()
+            self._context = None
+
+    def _run(self):
+        statistics = self._context.socket(zmq.SUB)
+        statistics.setsockopt(zmq.LINGER, 0)
+        statistics.setsockopt(zmq.SUBSCRIBE, b"")
+        statistics.connect(self.socket)
+
+        try:
+            while not self._stop.is_set():
+
+                # wait for a message without blocking the shutdown
+                if not statistics.poll(self.poll_interval, zmq.POLLIN):
+                    continue
+
+                febs = _parse_stats(statistics.recv_string())
+
+                with self._updated:
+                    self._febs = febs
+                    self._messages += 1
+                    self._last_update = time.time()
+                    self._updated.notify_all()
+        finally:
+            statistics.close()
+
+    def wait(self, timeout=None, messages=1):
+        """Waits until the given number of statistics messages has been received.
+        Returns False if the timeout expired before."""
+
+        with self._updated:
+            return self._updated.wait_for(lambda: self._messages >= messages, timeout)
+
+    def age(self):
+        """Returns the seconds since the last statistics message or None"""
+
+        with self._lock:
+            if self._last_update is None:
+                return None
+            return time.time() - self._last_update
+
+    def febs(self, timeout=None):
+        """Returns a list containing the serial numbers of the connected febs.
+        Raises a TimeoutError if no statistics message has been received in time."""
+
+        if not self.wait(timeout):
+            raise TimeoutError('No statistics received from %s' % self.socket)
+
+        with self._lock:
+            febs = sorted(self._febs)
+
+        _register(febs)
+
+        return febs
+
+    def status(self, feb=None, timeout=None):
+        """Returns the status of the given feb.
+        If no feb is given, return the status of all the febs."""
+
+        if not self.wait(timeout):
+            raise TimeoutError('No statistics received from %s' % self.socket)
+
+        with self._lock:
+            if feb is None:
+                return {_f: dict(_s) for _f, _s in self._febs.items()}
+            return dict(self._febs[feb]) if feb in self._febs else None
+
+    def rates(self, febs=[], messages=1, timeout=None):
+        """Waits for the given number of new statistics messages and returns
+        the mean event rate of the given febs over them as {feb: rate}.
+        If the list of febs is empty, return the rates of all the febs."""
+
+        # We need a list of febs, if only one is given,
+        # generate a list with a single element
+        if type(febs) == int:
+            febs = [febs]
+
+        with self._lock:
+            start = self._messages
+
+        sums = {}
+        counts = {}
+        for nr in range(messages):
+            with self._updated:
+                if not self._updated.wait_for(lambda: self._messages > start + nr, timeout):
+                    raise TimeoutError('No statistics received from %s' % self.socket)
+                for feb, status in self._febs.items():
+                    if not len(febs) or feb in febs:
+                        sums[feb] = sums.get(feb, 0.0) + status['evtrate']
+                        counts[feb] = counts.get(feb, 0) + 1
+
+        return {feb: sums[feb] / counts[feb] for feb in sums}
+
+    def healthy(self, febs=[], min_rate=0.0, max_lost=None, configured=True, biason=False, timeout=None):
+        """Returns the subset of the given febs which are connected, error free
+        and satisfy the given rate, lost events and configuration requirements.
+        If the list of febs is empty, check all the connected febs."""
+
+        # We need a list of febs, if only one is given,
+        # generate a list with a single element
+        if type(febs) == int:
+            febs = [febs]
+
+        status = self.status(timeout=timeout)
+
+        # Use all connected febs if the given list is empty
+        if not len(febs):
+            febs = sorted(status)
+
+        healthy = []
+        for feb in febs:
+            _s = status.get(feb)
+            if _s is None or not _s['connected'] or _s['error']:
+                continue
+            if _s['evtrate'] < min_rate:
+                continue
+            if max_lost is not None and _s['lostcpu'] + _s['lostfpga'] > max_lost:
+                continue
+            if configured and not _s['configured']:
+                continue
+            if biason and not _s['biason']:
+                continue
+            healthy.append(feb)
+
+        return healthy
+
+
+# API functions
+
+def connected_febs(socket="tcp://localhost:5557", timeout=None, registry=None, session=None):
+    """Returns a list containing the serial numbers of the connected febs.
+    If a registry is given, answer from its live table instead of subscribing.
+    Raises a TimeoutError if no statistics are received within timeout seconds."""
+
+    if registry is not None:
+        return registry.febs(timeout=timeout)
+
+    session = session or default_session()
+
+    # statistics publisher, only the latest message is of interest
+    statistics = session.socket(zmq.SUB, socket, options={
+        zmq.SUBSCRIBE: b"",
+        zmq.CONFLATE: 1
+    })
+
+    # get the list of connected febs, a subscription kept between
+    # calls would answer with a stale message once the driver stopped
+    try:
+        if not statistics.poll(None if timeout is None else int(1000 * timeout), zmq.POLLIN):
+            raise TimeoutError('No statistics received from %s' % socket)
+        message = statistics.recv_string()
+    finally:
+        session.release(zmq.SUB, socket)
+
+    # the connected feb's serial numbers
+    febs = list(_parse_stats(message))
+
+    # store the febs
+    _register(febs)
 
     return febs
 
@@ -173,6 +435,13 @@ def set_voltages(values, febs=[]):
         _configs[feb] = bitstring
 
 
+def get_voltages(feb):
+    """Returns the voltages of all the channels of the given feb"""
+
+    bitstring = _configs[feb]
+    return [int(bitstring[331+9*channel:331+9*channel+8], 2) for channel in range(32)]
+
+
 def set_thresholds(values, febs=[]):
     """Sets the threshold for the given febs.
     If only one threshold is set, set both thresholds to the same value.
@@ -213,6 +482,51 @@ def set_thresholds(values, febs=[]):
         _configs[feb] = bitstring
 
 
+def configure(
+    febs=[],
+    driver='tcp://localhost:5555',
+    pm_path='CONF/PM.txt',
+    settle=2.,
+    session=None
+):
+    """Sends the configurations of the given febs to the driver.
+    The data acquisition is stopped once for all the febs while they are
+    configured and restarted after waiting settle seconds.
+    If the list of febs is empty, configure all the febs."""
+
+    # We need a list of febs, if only one is given,
+    # generate a list with a single element
+    if type(febs) == int:
+        febs = [febs]
+
+    # Use all connected febs if the given list is empty
+    if not len(febs):
+        febs = _configs.keys()
+
+    session = session or default_session()
+    socket = session.socket(zmq.REQ, driver)
+
+    # the probe configuration is the same for all the febs
+    pm_bytes = bytes(_encrypt(_bits_from_file(pm_path)))
+
+    try:
+        with profiling.region('daq.configure'):
+            _send_command(socket, 'DAQ_END', 255)
+            for feb in febs:
+                if _configs.get(feb) is None:
+                    continue
+                _send_command(socket, 'BIAS_OF', feb)
+                _send_command(socket, 'SETCONF', feb, bytes(_encrypt(_configs[feb])) + pm_bytes)
+                _send_command(socket, 'BIAS_ON', feb)
+            time.sleep(settle)
+            _send_command(socket, 'DAQ_BEG', 255)
+
+    # a request socket without reply can't be used anymore
+    except TimeoutError:
+        session.release(zmq.REQ, driver)
+        raise
+
+
 def start_histos(
     febs=[],
     events=1000,
@@ -220,10 +534,15 @@ def start_histos(
     input_socket='tcp://localhost:5556',
     output_socket='tcp://localhost:9999',
     continuous=False,
-    enable_all=False
+    enable_all=False,
+    as_is=False
 ):
     """Starts histogram builders for the given list of febs.
-    If the list of febs is empty, start histogram builders for all the febs."""
+    If the list of febs is empty, start histogram builders for all the febs.
+    If as_is is set, the triggers and amplifications of the configuration
+    are used as they are, ex. during data taking. Note that histos stops
+    the data acquisition of all the febs for about 2 seconds whenever it
+    configures its feb, which it does for every pair of channels."""
 
     # We need a list of febs, if only one is given,
     # generate a list with a single element
@@ -251,6 +570,10 @@ def start_histos(
     if enable_all:
       input_args += ['--all']
 
+    # Use the configuration as it is
+    if as_is:
+      input_args += ['--as_is']
+
     # Start a histos subprocess for every connected feb
     return [subprocess.Popen(
         input_args + ['--febsn', str(feb), '--hexstring', _bits_to_hex(_configs[feb])]
@@ -276,6 +599,181 @@ def task_to_data(data):
   return mac5, config, pedestals, spectra
 
 
+def _store_task(task, path, writer=None):
+  """Stores a histos task either in the archive of the given writer or
+  pickled into files. Returns the crt, the config, the location and
+  the record of the stored histograms."""
+
+  if writer is not None:
+    return task[0], task[1:1+143].hex(), path, writer.write(task)
+
+  crt, config, pedestals, spectra = task_to_data(task)
+  now = str(datetime.now())
+
+  f = open('%s/%02x-%s.task' % (path, crt, now), "wb")
+  pickle.dump(task, f)
+  f.close()
+
+  location = '%s/%02x-%s.histos' % (path, crt, now)
+  f = open(location, "wb")
+  pickle.dump((crt, config, pedestals, spectra), f)
+  f.close()
+
+  return crt, config, location, None
+
+
+def _receive(crts, path, nr_histograms, port, archive, progress):
+  """Receives, decodes and stores the histograms of the given CRT modules
+  and reports every stored task to the coordinator.
+  Runs in a receiver process of a sharded acquisition."""
+
+  context  = zmq.Context()
+  puller   = context.socket(zmq.PULL)
+  reporter = context.socket(zmq.PUSH)
+  puller.bind('tcp://*:%d' % port)
+  reporter.connect(progress)
+
+  writer = ArchiveWriter(path) if archive else None
+
+  counters = {crt: 0 for crt in crts}
+  try:
+    while min(counters.values()) < nr_histograms:
+      task = puller.recv()
+      if task[0] not in counters:
+        continue
+
+      crt, config, location, record = _store_task(task, path, writer)
+      counters[crt] += 1
+
+      reporter.send_json({
+        'crt': crt,
+        'time': time.time(),
+        'config': config,
+        'location': location,
+        'record': record
+      })
+
+  finally:
+    if writer is not None:
+      writer.close()
+    puller.close(linger=0)
+    reporter.close()
+    context.term()
+
+
+def _acquire_sharded(
+  crts,
+  path,
+  nr_histograms,
+  events,
+  driver,
+  data,
+  port,
+  shards,
+  session,
+  archive,
+  catalog,
+  bias,
+  run,
+  stage
+):
+  """Collects the histograms using a receiver process for every shard of
+  the CRT modules, each listening on its own port. Returns the number of
+  histograms collected for every CRT module."""
+
+  # the receivers report to the coordinator on a port of their own
+  progress = session.context.socket(zmq.PULL)
+  progress.setsockopt(zmq.LINGER, 0)
+  progress_port = progress.bind_to_random_port('tcp://127.0.0.1')
+
+  # the receivers get fresh processes, zeromq contexts can't be forked
+  spawn = multiprocessing.get_context('spawn')
+
+  receivers = []
+  histos = []
+  for shard in range(shards):
+    _crts = crts[shard::shards]
+    if not _crts:
+      continue
+
+    # every receiver writes an archive of its own
+    _path = '%s/shard_%02d' % (path, shard) if archive else path
+
+    # a receiver binds the port, free it if this process bound it earlier
+    session.release(zmq.PULL, 'tcp://*:%d' % (port + shard), bind=True)
+
+    receiver = spawn.Process(
+      target=_receive,
+      args=(_crts, _path, nr_histograms, port + shard, archive, 'tcp://127.0.0.1:%d' % progress_port),
+      daemon=True
+    )
+    receiver.start()
+    receivers.append(receiver)
+
+    # Start the histogram builders of the shard
+    histos += start_histos(
+      febs=_crts,
+      events=events,
+      driver=driver,
+      input_socket=data,
+      output_socket='tcp://localhost:%d' % (port + shard),
+      continuous=True
+    )
+  print("  Started observations with %d receivers " % len(receivers), str(datetime.now()))
+
+  # Aggregate the progress of the receivers
+  counters = {crt: 0 for crt in crts}
+
+  def record(stored):
+    counters[stored['crt']] += 1
+    print(str(datetime.now()), ' - got histograms from CRT module %d' % stored['crt'])
+
+    if catalog is not None:
+      with profiling.region('daq.catalog'):
+        catalog.add(
+          stored['crt'],
+          stored['time'],
+          stored['config'],
+          stored['location'],
+          stored['record'],
+          bias=bias,
+          run=run,
+          stage=stage
+        )
+
+  try:
+    while min(counters.values()) < nr_histograms:
+      with profiling.region('daq.receive'):
+        stored = progress.recv_json() if progress.poll(1000, zmq.POLLIN) else None
+
+      if stored is None:
+        failed = [r for r in receivers if r.exitcode not in (None, 0)]
+        if failed:
+          raise RuntimeError('%d receiver processes failed' % len(failed))
+        continue
+      record(stored)
+
+    # the receivers keep storing the histograms of their faster CRT
+    # modules until their slowest one is done, catalog these as well
+    for receiver in receivers:
+      receiver.join(10)
+    while progress.poll(100, zmq.POLLIN):
+      record(progress.recv_json())
+
+  finally:
+    # Stop the running histos instances
+    for h in histos:
+      h.terminate()
+
+    for receiver in receivers:
+      if receiver.is_alive():
+        receiver.terminate()
+
+    progress.close()
+
+  return counters
+
+
 def acquire(
   crts,
   path='data',
@@ -283,19 +781,62 @@ def acquire(
   events=5000,
   driver='tcp://localhost:5555',
   data='tcp://localhost:5556',
-  port=6000
+  port=6000,
+  session=None,
+  archive=False,
+  catalog=None,
+  bias=None,
+  run=None,
+  stage=None,
+  shards=1
 ):
   """Collects and stores a number of histograms with a given
-  number of events for the given list of CRT modules"""
+  number of events for the given list of CRT modules.
+  If archive is set, the histograms are appended to a compressed
+  archive in path instead of being pickled into separate files.
+  If a catalog is given, the histograms are recorded in it along
+  with the given bias setting, run and stage of the run.
+  With several shards, the CRT modules are split among as many receiver
+  processes listening on consecutive ports starting at port, which
+  decode and store the histograms independently."""
 
-  context = zmq.Context()
-  puller  = context.socket(zmq.PULL)
-  puller.bind('tcp://*:%d' % port)
+  session = session or default_session()
 
   # force crts to be a list
   if type(crts) == int:
     crts = [crts]
 
+  if shards > 1:
+    _acquire_sharded(
+      crts,
+      path,
+      nr_histograms,
+      events,
+      driver,
+      data,
+      port,
+      shards,
+      session,
+      archive,
+      catalog,
+      bias,
+      run,
+      stage
+    )
+
+    if catalog is not None:
+      catalog.commit()
+
+    print('Finished round at %s' % str(datetime.now()))
+    return
+
+  puller  = session.socket(zmq.PULL, 'tcp://*:%d' % port, bind=True)
+
+  # discard the histograms left over from a previous acquisition
+  session.drain(puller)
+
+  writer = ArchiveWriter(path) if archive else None
+
   # Start the histogram builders
   histos = start_histos(
     febs=crts,
@@ -310,8 +851,11 @@ def acquire(
   # Collect a certain number of histograms in total
   counters = [0]*len(crts)
   while min(counters) < nr_histograms:
-    task = puller.recv()
-    crt, config, pedestals, spectra = task_to_data(task)
+    with profiling.region('daq.receive'):
+      task = puller.recv()
+
+    with profiling.region('daq.store'):
+      crt, config, location, record = _store_task(task, path, writer)
 
     # Count up the task
     counters[crts.index(crt)] += 1
@@ -319,18 +863,18 @@ def acquire(
     now = str(datetime.now())
     print(now, ' - got histograms from CRT module %d' % crt)
 
-    f = open('%s/%02x-%s.task' % (path, crt, now), "wb")
-    pickle.dump(task, f)
-    f.close()
-
-    f = open('%s/%02x-%s.histos' % (path, crt, now), "wb")
-    pickle.dump((crt, config, pedestals, spectra), f)
-    f.close()
+    if catalog is not None:
+      with profiling.region('daq.catalog'):
+        catalog.add(crt, time.time(), config, location, record, bias=bias, run=run, stage=stage)
 
   # Stop the running histos instances
   for h in histos:
     h.terminate()
 
-  print('Finished round at %s' % str(datetime.now()))
+  if writer is not None:
+    writer.close()
+
+  if catalog is not None:
+    catalog.commit()
 
-  # TODO: close the context or use the python decorator
+  print('Finished round at %s' % str(datetime.now()))
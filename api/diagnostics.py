@@ -0,0 +1,224 @@
+"""Diagnostic plots and reports of the calibration.
+
+This module imports plotly, which is slow to import. It is therefore only
+imported when visuals are requested, and the reports are rendered after
+the calibration in a pool of worker processes."""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import plotly.offline    as po
+import plotly.graph_objs as go
+import numpy             as np
+import os
+import pickle
+
+from .calc    import iter_histograms
+from .catalog import Catalog
+
+## internal functions
+
+def _gauss(x, A, μ, σ):
+  return A * np.exp(- (x-μ)**2 / (2.0 * σ**2))
+
+
+def _load_spectra(catalog, crt, bias, run=None):
+  """Returns the summed spectra of every SiPM for the given crt and bias,
+  acquired in the given run"""
+
+  spectra = None
+  for mac5, config, pp, ss in iter_histograms(catalog, crts=crt, run=run, stage='bias_%d' % bias):
+    if spectra is None:
+      spectra = np.zeros((len(ss), len(ss[0])))
+    spectra += np.array(ss)
+  return spectra
+
+
+def _load_fits(path, crt, bias):
+  """Returns the peaks, distances and gains stored for the given crt and bias"""
+
+  filename = '%s/bias_%d/%02x.diagnostics' % (path, bias, crt)
+  if not os.path.exists(filename):
+    return {}, {}, {}
+  file = open(filename, 'rb')
+  peaks, distances, gains = pickle.load(file)
+  file.close()
+  return peaks, distances, gains
+
+
+def _spectra_figure(spectra, bias, sipms):
+  return go.Figure(
+    data=[go.Scatter(
+      x=list(range(spectra.shape[1])),
+      y=spectra[sipm],
+      name='SiPM %02d' % sipm,
+      visible=True if sipm == sipms[0] else 'legendonly'
+    ) for sipm in sipms],
+    layout=go.Layout(
+      title='Spectra at bias %d' % bias,
+      xaxis={'title':'ADC Counts / Bin Nr'},
+      yaxis={'title':'Nr Events', 'type':'log'}
+    )
+  )
+
+
+def _distances_figure(distances, gains, bias, sipms):
+  data = []
+  for sipm in sipms:
+    if sipm not in distances:
+      continue
+    visible = True if sipm == sipms[0] else 'legendonly'
+
+    # same binning as used by api.calc.get_gains
+    ydata, edges = np.histogram(
+        [d for d, _ in distances[sipm]],
+        bins=50,
+        range=[20, 120]
+    )
+    xdata = (edges[:-1] + edges[1:]) / 2
+    data.append(go.Bar(
+      x=xdata,
+      y=ydata,
+      name='SiPM %02d' % sipm,
+      visible=visible
+    ))
+
+    if sipm in gains:
+      (A, μ, σ), pcov = gains[sipm]
+      x_range = np.linspace(20, 120, 200)
+      data.append(go.Scatter(
+        x=x_range,
+        y=_gauss(x_range, A, μ, σ),
+        name='SiPM %02d μ=%.2f (%.2f)' % (sipm, μ, np.sqrt(pcov[1][1])),
+        visible=visible
+      ))
+
+  return go.Figure(
+    data=data,
+    layout=go.Layout(
+      title='Distances between peaks at bias %d' % bias,
+      xaxis={'title':'Distance / ADC Counts'},
+      yaxis={'title':'Nr Distances'}
+    )
+  )
+
+
+def _gains_figure(gains, bias_settings, sipms):
+  data = []
+  for sipm in sipms:
+    _bias = [bias for bias in bias_settings if sipm in gains[bias]]
+    if not _bias:
+      continue
+    _gains = [gains[bias][sipm][0][1] for bias in _bias]
+    _uncerts = [np.sqrt(gains[bias][sipm][1][1][1]) for bias in _bias]
+    data.append(go.Scatter(
+      x=_bias,
+      y=_gains,
+      error_y={'type':'data', 'array':_uncerts},
+      mode='lines+markers',
+      name='SiPM %02d' % sipm
+    ))
+
+  return go.Figure(
+    data=data,
+    layout=go.Layout(
+      title='Gain vs bias',
+      xaxis={'title':'Bias setting'},
+      yaxis={'title':'Gain / ADC Counts per p.e.'}
+    )
+  )
+
+
+def _render_crt(path, output, crt, bias_settings, sipms, run=None):
+  """Renders the report of a crt to a static html file"""
+
+  figures = []
+  gains = {}
+  with Catalog(path) as catalog:
+    for bias in bias_settings:
+      peaks, distances, gains[bias] = _load_fits(path, crt, bias)
+
+      spectra = _load_spectra(catalog, crt, bias, run)
+      if spectra is not None:
+        figures.append(_spectra_figure(spectra, bias, sipms))
+
+      if distances:
+        figures.append(_distances_figure(distances, gains[bias], bias, sipms))
+
+  figures.append(_gains_figure(gains, bias_settings, sipms))
+
+  # the plotly javascript is embedded once, along with the first figure
+  divs = [po.plot(
+    figure,
+    output_type='div',
+    include_plotlyjs=(nr == 0)
+  ) for nr, figure in enumerate(figures)]
+
+  filename = '%s/%02x.html' % (output, crt)
+  f = open(filename, 'w')
+  f.write('<html><head><meta charset="utf-8"><title>CRT Module %d</title></head><body>\n' % crt)
+  f.write('<h1>CRT Module %d</h1>\n' % crt)
+  f.write('\n'.join(divs))
+  f.write('\n</body></html>\n')
+  f.close()
+
+  return filename
+
+
+## api functions
+
+def plot_fit(xdata, ydata, params, pcov):
+  """Shows a fitted gaussian inline (ex. in a notebook)"""
+
+  x_range = np.linspace(min(xdata), max(xdata), 100)
+  y_gauss = _gauss(x_range, params[0], params[1], params[2])
+
+  po.iplot(go.Figure(
+    data=[go.Bar(
+      x=xdata,
+      y=ydata,
+      name='data'
+    ), go.Scatter(
+      x=x_range,
+      y=y_gauss,
+      name='μ=%.2f (%.2f)' % (params[1], pcov[1][1])
+    )],
+    layout=go.Layout(
+      title='Fitted gaussian',
+      xaxis={'title':'ADC Counts / Bin Nr'},
+      yaxis={'title':'Nr Events'}
+    )
+  ))
+
+
+def store_fits(path, crt, bias, peaks, distances, gains):
+  """Stores the peaks, distances and gains of a crt for the report"""
+
+  f = open('%s/bias_%d/%02x.diagnostics' % (path, bias, crt), 'wb')
+  pickle.dump((peaks, distances, gains), f)
+  f.close()
+
+
+def generate_report(
+  path,
+  crts,
+  bias_settings,
+  sipms=range(32),
+  output=None,
+  processes=None,
+  run=None
+):
+  """Renders the spectra, peak fits and gain vs bias plots of
+  the given crts to static html files using a pool of processes.
+  The spectra are the ones of the catalog in path, acquired in the
+  given run. Returns the list of generated files."""
+
+  output = output or '%s/report' % path
+  os.makedirs(output, exist_ok=True)
+
+  sipms = list(sipms)
+
+  with ProcessPoolExecutor(max_workers=processes) as executor:
+    futures = [executor.submit(
+      _render_crt, path, output, crt, bias_settings, sipms, run
+    ) for crt in crts]
+    return [future.result() for future in futures]
@@ -0,0 +1,207 @@
+import json
+import numpy as np
+import time
+import zmq
+
+from datetime import datetime
+
+from . import calc
+from . import daq
+from .session import default_session
+
+## api classes
+
+class GainMonitor(object):
+  """Tracks the gains of the SiPMs using the continuous stream of
+  histograms, ex. during physics data taking.
+
+  Every CRT module's spectra are accumulated with an exponential decay,
+  so old snapshots fade out with the given half life. On a schedule, the
+  gains are re-estimated for the SiPMs which received enough new events
+  and compared to the reference gains. The gains and drift alerts are
+  published as json strings prefixed by the topics 'gains' and 'alert'."""
+
+  def __init__(
+    self,
+    crts,
+    reference={},
+    tolerance=.05,
+    half_life=600.,
+    interval=60.,
+    min_events=50000,
+    min_quality=.2,
+    window=(300, 1000),
+    gain_range=(20, 120),
+    session=None
+  ):
+    # force crts to be a list
+    if type(crts) == int:
+      crts = [crts]
+
+    self.crts = list(crts)
+    self.tolerance = tolerance
+    self.half_life = half_life
+    self.interval = interval
+    self.min_events = min_events
+    self.min_quality = min_quality
+    self.window = window
+    self.gain_range = gain_range
+    self.session = session or default_session()
+
+    # the reference gains {(crt, sipm): gain}, if a SiPM has no reference,
+    # its first estimated gain is taken as reference
+    self.reference = dict(reference)
+
+    # the decayed spectra of every CRT module, the events added to
+    # them since the last estimation and the time of the last update
+    self.spectra = {}
+    self.fresh = {}
+    self.updated = {}
+
+    # the latest estimated gains {(crt, sipm): (gain, quality, time)}
+    self.gains = {}
+
+    # the SiPMs whose gain drifted out of tolerance {(crt, sipm): drift}
+    self.drifted = {}
+
+  def add(self, crt, spectra, now=None):
+    """Decays the accumulated spectra of a CRT module and adds a snapshot"""
+
+    now = time.time() if now is None else now
+    spectra = np.asarray(spectra, dtype=float)
+
+    if crt not in self.spectra:
+      self.spectra[crt] = np.zeros(spectra.shape)
+      self.fresh[crt] = np.zeros(len(spectra))
+      self.updated[crt] = now
+
+    decay = .5 ** ((now - self.updated[crt]) / self.half_life)
+    self.spectra[crt] *= decay
+    self.spectra[crt] += spectra
+    self.fresh[crt] += spectra[:, self.window[0]:self.window[1]].sum(axis=1)
+    self.updated[crt] = now
+
+  def estimate(self, now=None):
+    """Re-estimates the gains of the SiPMs with enough new events.
+    Returns the updated gains {(crt, sipm): gain} and the alerts."""
+
+    now = time.time() if now is None else now
+    updated = {}
+    alerts = []
+
+    for crt in self.spectra:
+      sipms = np.flatnonzero(self.fresh[crt] >= self.min_events)
+      if not len(sipms):
+        continue
+
+      gains, quality = calc.estimate_gains(
+        self.spectra[crt][sipms],
+        window=self.window,
+        gain_range=self.gain_range
+      )
+      self.fresh[crt][sipms] = 0
+
+      for sipm, gain, _q in zip(sipms.tolist(), gains.tolist(), quality.tolist()):
+        if _q < self.min_quality:
+          continue
+
+        self.gains[(crt, sipm)] = (gain, _q, now)
+        updated[(crt, sipm)] = gain
+
+        reference = self.reference.setdefault((crt, sipm), gain)
+        drift = (gain - reference) / reference
+
+        if abs(drift) > self.tolerance:
+          self.drifted[(crt, sipm)] = drift
+          alerts.append({
+            'crt': crt,
+            'sipm': sipm,
+            'gain': gain,
+            'reference': reference,
+            'drift': drift,
+            'time': now
+          })
+        else:
+          self.drifted.pop((crt, sipm), None)
+
+    return updated, alerts
+
+  def publish(self, publisher, updated, alerts):
+    """Publishes the updated gains per CRT module and the alerts"""
+
+    for crt in sorted(set(crt for crt, _ in updated)):
+      publisher.send_string('gains ' + json.dumps({
+        'crt': crt,
+        'time': self.updated[crt],
+        'gains': {sipm: self.gains[(crt, sipm)][0] for _c, sipm in updated if _c == crt},
+        'reference': {sipm: self.reference[(crt, sipm)] for _c, sipm in updated if _c == crt}
+      }))
+
+    for alert in alerts:
+      publisher.send_string('alert ' + json.dumps(alert))
+
+  def run(
+    self,
+    duration=None,
+    events=5000,
+    driver='tcp://localhost:5555',
+    data='tcp://localhost:5556',
+    port=6000,
+    publish='tcp://*:6500'
+  ):
+    """Starts continuous histogram builders for the monitored CRT modules
+    and tracks their gains for the given duration in seconds, or until
+    interrupted if no duration is given.
+    The histogram builders keep the triggers of the configuration, but
+    still pause the data acquisition of all the CRT modules whenever
+    they reconfigure their module (see api.daq.start_histos)."""
+
+    puller    = self.session.socket(zmq.PULL, 'tcp://*:%d' % port, bind=True)
+    publisher = self.session.socket(zmq.PUB, publish, bind=True)
+
+    # discard the histograms left over from a previous acquisition
+    self.session.drain(puller)
+
+    histos = daq.start_histos(
+      febs=self.crts,
+      events=events,
+      driver=driver,
+      input_socket=data,
+      output_socket='tcp://localhost:%d' % port,
+      continuous=True,
+      as_is=True
+    )
+    print("Started monitoring ", str(datetime.now()))
+
+    started = time.time()
+    scheduled = started + self.interval
+    try:
+      while duration is None or time.time() - started < duration:
+
+        # wait for snapshots until the next estimation is due
+        timeout = max(0, scheduled - time.time())
+        if puller.poll(int(1000 * timeout), zmq.POLLIN):
+          crt, config, pedestals, spectra = daq.task_to_data(puller.recv())
+          if crt in self.crts:
+            self.add(crt, spectra)
+
+        if time.time() >= scheduled:
+          updated, alerts = self.estimate()
+          self.publish(publisher, updated, alerts)
+          for alert in alerts:
+            print('%s - CRT Module %d SiPM %02d drifted by %+.1f%%' % (
+              str(datetime.now()), alert['crt'], alert['sipm'], 100 * alert['drift']
+            ))
+          scheduled += self.interval
+
+    except KeyboardInterrupt:
+      pass
+
+    finally:
+      # Stop the running histos instances
+      for h in histos:
+        h.terminate()
+
+    print("Stopped monitoring ", str(datetime.now()))
+
+    return dict(self.drifted)
@@ -0,0 +1,139 @@
+"""Named profiling regions of the calibration pipeline.
+
+The stages of the pipeline are wrapped in regions, ex.
+
+  with profiling.region('calc.fitter'):
+    answer = puller.recv_string()
+
+which cost next to nothing unless profiling is started. Once started,
+every enabled region is profiled with cProfile and its calls, wall time,
+CPU time and peak memory (tracemalloc) are summed up. Regions are named
+'<stage>.<step>', enabling a stage enables all of its steps.
+
+Only the innermost active region is profiled with cProfile, the outer
+ones are paused meanwhile. Wall and CPU times and the peak memory of a
+region include the nested regions. Regions are only profiled in the
+main thread of the main process (ex. not in the receivers of a sharded
+acquisition)."""
+
+import contextlib
+import cProfile
+import os
+import threading
+import time
+import tracemalloc
+
+## internal variables
+
+# folder to write the profiles to, None if profiling is stopped
+_path = None
+
+# names of the regions or stages to profile, None for all
+_regions = None
+
+# the profiler of every region
+_profiles = {}
+
+# calls, wall time, cpu time and peak memory of every region
+_totals = {}
+
+# the active regions, innermost last
+_stack = []
+
+## api functions
+
+def start(path, regions=None):
+  """Starts profiling the given regions (all if None) into path"""
+
+  global _path, _regions
+
+  os.makedirs(path, exist_ok=True)
+  _path = path
+  _regions = None if regions is None else set(regions)
+  _profiles.clear()
+  _totals.clear()
+
+  if not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+def enabled(name):
+  """Returns whether the region with the given name is profiled"""
+
+  if _path is None:
+    return False
+  return _regions is None or name in _regions or name.split('.')[0] in _regions
+
+
+@contextlib.contextmanager
+def region(name):
+  """Profiles the enclosed code as the region with the given name"""
+
+  if not enabled(name) or threading.current_thread() is not threading.main_thread():
+    yield
+    return
+
+  # only the innermost region is profiled, pause the outer one
+  current, peak = tracemalloc.get_traced_memory()
+  if _stack:
+    _profiles[_stack[-1]['name']].disable()
+    _stack[-1]['peak'] = max(_stack[-1]['peak'], peak)
+  tracemalloc.reset_peak()
+
+  frame = {'name': name, 'start': current, 'peak': current}
+  _stack.append(frame)
+
+  profile = _profiles.setdefault(name, cProfile.Profile())
+  wall, cpu = time.perf_counter(), time.process_time()
+  profile.enable()
+  try:
+    yield
+
+  finally:
+    profile.disable()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    _stack.pop()
+
+    peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+    totals = _totals.setdefault(name, [0, 0., 0., 0])
+    totals[0] += 1
+    totals[1] += wall
+    totals[2] += cpu
+    totals[3] = max(totals[3], peak - frame['start'])
+
+    # resume the outer region
+    if _stack:
+      _stack[-1]['peak'] = max(_stack[-1]['peak'], peak)
+      _profiles[_stack[-1]['name']].enable()
+
+
+def summary():
+  """Returns {region: (calls, wall time, cpu time, peak memory in bytes)}"""
+
+  return {name: tuple(totals) for name, totals in _totals.items()}
+
+
+def stop():
+  """Stops profiling and writes a cProfile dump of every region
+  (<region>.prof, ex. for pstats or snakeviz) and the summary of
+  all the regions (summary.txt). Returns the summary filename."""
+
+  global _path
+
+  if _path is None:
+    return None
+
+  for name, profile in _profiles.items():
+    profile.dump_stats('%s/%s.prof' % (_path, name))
+
+  filename = '%s/summary.txt' % _path
+  f = open(filename, 'w')
+  f.write('%-24s %8s %12s %12s %12s\n' % ('region', 'calls', 'wall [s]', 'cpu [s]', 'peak [MiB]'))
+  for name, (calls, wall, cpu, peak) in sorted(_totals.items(), key=lambda item: -item[1][1]):
+    f.write('%-24s %8d %12.3f %12.3f %12.2f\n' % (name, calls, wall, cpu, peak / 2**20))
+  f.close()
+
+  tracemalloc.stop()
+  _path = None
+
+  return filename
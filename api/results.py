@@ -0,0 +1,176 @@
+import numpy as np
+import os
+import sqlite3
+import time
+
+from datetime import datetime
+
+## internal variables
+
+# the columns of the tables, besides the run and the time of the run
+_tables = {
+  'gains': (
+    ('crt', 'INTEGER'),
+    ('sipm', 'INTEGER'),
+    ('bias', 'INTEGER'),
+    ('stage', 'TEXT'),
+    ('gain', 'REAL'),
+    ('width', 'REAL'),
+    ('error', 'REAL'),
+  ),
+  'dependencies': (
+    ('crt', 'INTEGER'),
+    ('sipm', 'INTEGER'),
+    ('slope', 'REAL'),
+    ('offset', 'REAL'),
+  ),
+  'bias_settings': (
+    ('crt', 'INTEGER'),
+    ('sipm', 'INTEGER'),
+    ('bias', 'INTEGER'),
+  ),
+}
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+  run         TEXT PRIMARY KEY,
+  time        REAL NOT NULL,
+  description TEXT
+);
+""" + "".join("""
+CREATE TABLE IF NOT EXISTS %s (
+  run TEXT NOT NULL REFERENCES runs (run),
+  %s
+);
+CREATE INDEX IF NOT EXISTS %s_crt_sipm ON %s (crt, sipm);
+CREATE INDEX IF NOT EXISTS %s_run ON %s (run);
+""" % (
+  table,
+  ',\n  '.join('%s %s' % column for column in columns),
+  table, table, table, table
+) for table, columns in _tables.items())
+
+
+## api classes
+
+class Results(object):
+  """Stores the results of the calibrations in a SQLite database.
+
+  The gains, dependencies of the gains on the bias and the calibrated
+  bias settings of every run are stored in tables keyed by run, CRT
+  module, SiPM and bias. Results are written in bulk from columns and
+  queries return columns as numpy arrays."""
+
+  def __init__(self, filename='data/results.sqlite'):
+    directory = os.path.dirname(filename)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    self.filename = filename
+    self.connection = sqlite3.connect(filename)
+    self.connection.executescript(_schema)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def new_run(self, run=None, description=None):
+    """Registers a new run and returns its name"""
+
+    now = time.time()
+    run = run or str(datetime.fromtimestamp(now))
+    self.connection.execute(
+      'INSERT OR IGNORE INTO runs (run, time, description) VALUES (?, ?, ?)',
+      (run, now, description)
+    )
+    self.connection.commit()
+    return run
+
+  def add(self, table, run, **columns):
+    """Adds the rows given as columns (lists or arrays of equal length)
+    to a table. Scalars are used for every row."""
+
+    names = [name for name, _ in _tables[table]]
+    size = max([np.size(values) for values in columns.values()] + [0])
+
+    # broadcast the scalars and convert numpy values to python values
+    values = [np.broadcast_to(np.asarray(columns.get(name), dtype=object), (size,)).tolist()
+      for name in names
+    ]
+
+    self.connection.executemany(
+      'INSERT INTO %s (run, %s) VALUES (?, %s)' % (table, ', '.join(names), ', '.join('?' * len(names))),
+      zip([run] * size, *values)
+    )
+    self.connection.commit()
+
+  def query(self, table, runs=[], crts=[], sipms=[], **conditions):
+    """Returns the rows of a table matching the given runs, crts, sipms and
+    other column values as a dict of numpy arrays, including the run time.
+    Empty lists match everything."""
+
+    conditions.update({'run': runs, 'crt': crts, 'sipm': sipms})
+
+    where = []
+    values = []
+    for column, value in conditions.items():
+      if type(value) in (list, tuple, range, np.ndarray):
+        if not len(value):
+          continue
+        where.append('%s.%s IN (%s)' % (table, column, ', '.join('?' * len(value))))
+        values += [v.item() if hasattr(v, 'item') else v for v in value]
+      elif value is not None:
+        where.append('%s.%s = ?' % (table, column))
+        values.append(value)
+
+    names = ['run'] + [name for name, _ in _tables[table]]
+    statement = 'SELECT %s, runs.time FROM %s JOIN runs USING (run)' % (
+      ', '.join('%s.%s' % (table, name) for name in names),
+      table
+    )
+    if where:
+      statement += ' WHERE ' + ' AND '.join(where)
+    statement += ' ORDER BY runs.time'
+
+    rows = self.connection.execute(statement, values).fetchall()
+    columns = list(zip(*rows)) if rows else [[] for name in names + ['time']]
+
+    return {name: np.array(column) for name, column in zip(names + ['time'], columns)}
+
+  def history(self, crt, sipm, stage=None):
+    """Returns the gain history of a SiPM over all the runs"""
+
+    return self.query('gains', crts=[crt], sipms=[sipm], stage=stage)
+
+  def latest(self, table, crts=[]):
+    """Returns the latest values of a table for every SiPM of the given
+    crts as a dict {(crt, sipm): row}, ex. the bias settings to load.
+    If the list of crts is empty, return the values of all the crts."""
+
+    result = self.query(table, crts=crts)
+    names = [name for name, _ in _tables[table] if name not in ('crt', 'sipm')]
+
+    # the rows are ordered by time, later runs overwrite earlier ones
+    latest = {}
+    for row in zip(result['crt'].tolist(), result['sipm'].tolist(), *[result[name].tolist() for name in names]):
+      latest[row[:2]] = row[2:] if len(row) > 3 else row[2]
+    return latest
+
+  def export(self, table, filename, run, crt, **conditions):
+    """Writes the rows of a table for a run and CRT module matching the
+    other given column values to a text file"""
+
+    result = self.query(table, runs=[run], crts=[crt], **conditions)
+    names = [name for name, _ in _tables[table] if name not in ('crt',)]
+
+    f = open(filename, 'w')
+    f.write('\t'.join(names) + '\n')
+    f.write('\n'.join('\t'.join(
+      '%.2f' % value if isinstance(value, float) else str(value) for value in row
+    ) for row in zip(*[result[name].tolist() for name in names])))
+    f.close()
+
+  def close(self):
+    self.connection.commit()
+    self.connection.close()
@@ -0,0 +1,111 @@
+import numpy as np
+
+from datetime import datetime
+
+from . import daq
+
+## api functions
+
+def optimal_thresholds(thresholds, rates, target_rate=None, min_rate=1., edge=.5, flat=.1):
+  """Returns the optimal threshold of every feb from its trigger rates,
+  given as array of shape (febs, thresholds), and NaN if there is none.
+
+  With a target rate, the optimal threshold is the lowest one with a rate
+  below it. Otherwise it is the center of the first plateau of the rate
+  curve after its first edge, ex. the plateau between the single and
+  double photo electron signals of the dark counts. Edges are where the
+  slope of the logarithm of the rate reaches the given fraction of its
+  maximum, plateaus where it is below the flat fraction. Rates below
+  min_rate count as no triggers. The rates are expected to decrease with
+  increasing thresholds."""
+
+  thresholds = np.asarray(thresholds, dtype=float)
+  rates = np.atleast_2d(np.asarray(rates, dtype=float))
+  triggers = rates >= min_rate
+
+  if target_rate is not None:
+    below = rates <= target_rate
+    optimal = thresholds[below.argmax(axis=1)]
+    return np.where(below.any(axis=1) & triggers.any(axis=1), optimal, np.nan)
+
+  # the slope of the logarithm of the rate curves
+  with np.errstate(invalid='ignore'):
+    logs = np.log(np.where(triggers, rates, np.nan))
+    slopes = np.abs(np.gradient(logs, thresholds, axis=1))
+  valid = np.isfinite(slopes)
+  steepest = np.where(valid, slopes, 0).max(axis=1)[:, None]
+  index = np.arange(len(thresholds))[None, :]
+
+  # the first edge of every curve
+  edges = valid & (slopes >= edge * steepest)
+  first_edge = np.where(edges.any(axis=1), edges.argmax(axis=1), len(thresholds))
+
+  # the first run of flat points after the first edge
+  flats = valid & (slopes < flat * steepest) & (index > first_edge[:, None])
+  start = flats.argmax(axis=1)
+  ends = ~flats & (index > start[:, None])
+  end = np.where(ends.any(axis=1), ends.argmax(axis=1), len(thresholds))
+  center = (start + end - 1) // 2
+
+  return np.where(flats.any(axis=1), thresholds[center], np.nan)
+
+
+def threshold_scan(
+  thresholds,
+  febs=[],
+  registry=None,
+  messages=3,
+  settle=2.,
+  timeout=10.,
+  driver='tcp://localhost:5555',
+  stats='tcp://localhost:5557',
+  pm_path='CONF/PM.txt',
+  session=None
+):
+  """Steps the trigger thresholds of all the given febs at the same time
+  and measures their trigger rates at each step using the statistics
+  of the driver. The rates are averaged over a number of statistics
+  messages. The febs need a loaded configuration, which is sent to
+  them again after the scan.
+  If the list of febs is empty, scan all the febs.
+  Returns the febs and their rates as array of shape (febs, thresholds)."""
+
+  # We need a list of febs, if only one is given,
+  # generate a list with a single element
+  if type(febs) == int:
+    febs = [febs]
+
+  # Use all configured febs if the given list is empty
+  if not len(febs):
+    febs = [feb for feb in daq._configs if daq._configs[feb] is not None]
+  febs = list(febs)
+
+  own_registry = registry is None
+  if own_registry:
+    registry = daq.FEBRegistry(socket=stats, session=session).start()
+
+  # keep the configurations to restore them after the scan
+  configs = {feb: daq._configs[feb] for feb in febs}
+
+  rates = np.full((len(febs), len(thresholds)), np.nan)
+  try:
+    for step, threshold in enumerate(thresholds):
+      print("%s - threshold %d" % (str(datetime.now()), threshold))
+
+      daq.set_thresholds(int(threshold), febs)
+      daq.configure(febs, driver=driver, pm_path=pm_path, settle=settle, session=session)
+
+      measured = registry.rates(febs, messages=messages, timeout=timeout)
+      for nr, feb in enumerate(febs):
+        rates[nr, step] = measured.get(feb, np.nan)
+
+  finally:
+    # send the original configurations back to the febs
+    daq._configs.update(configs)
+    try:
+      daq.configure(febs, driver=driver, pm_path=pm_path, settle=settle, session=session)
+    finally:
+      if own_registry:
+        registry.stop()
+
+  return febs, rates
@@ -0,0 +1,112 @@
+import atexit
+import threading
+import zmq
+
+## internal variables
+
+# the session used by the api functions if none is given
+_default = None
+_default_lock = threading.Lock()
+
+
+## api classes
+
+class Session(object):
+  """Owns a single zeromq context and a pool of reusable sockets.
+
+  Sockets are keyed by their type, endpoint and whether they are bound
+  or connected, so repeated calls of the api functions reuse the same
+  connections instead of creating new contexts and sockets each time.
+  The pooled sockets must only be used from the thread using the session."""
+
+  def __init__(self, io_threads=1, sndhwm=1000, rcvhwm=1000, linger=0):
+    self.io_threads = io_threads
+    self.sndhwm = sndhwm
+    self.rcvhwm = rcvhwm
+    self.linger = linger
+
+    self.context = zmq.Context(io_threads=io_threads)
+    self._sockets = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  @property
+  def closed(self):
+    return self.context is None or self.context.closed
+
+  def socket(self, kind, endpoint, bind=False, options={}):
+    """Returns the pooled socket of the given type for the given endpoint.
+    The socket is created, configured and connected (or bound) on first use.
+    The options are only applied to newly created sockets."""
+
+    key = (kind, endpoint, bind)
+    if key in self._sockets:
+      return self._sockets[key]
+
+    socket = self.context.socket(kind)
+    socket.setsockopt(zmq.LINGER, self.linger)
+    socket.setsockopt(zmq.SNDHWM, self.sndhwm)
+    socket.setsockopt(zmq.RCVHWM, self.rcvhwm)
+
+    # some options (ex. CONFLATE) only apply if set before connecting
+    for option, value in options.items():
+      socket.setsockopt(option, value)
+
+    if bind:
+      socket.bind(endpoint)
+    else:
+      socket.connect(endpoint)
+
+    self._sockets[key] = socket
+    return socket
+
+  def release(self, kind, endpoint, bind=False):
+    """Closes and removes a pooled socket"""
+
+    socket = self._sockets.pop((kind, endpoint, bind), None)
+    if socket is not None:
+      socket.close()
+
+  def drain(self, socket):
+    """Discards the messages already queued in a socket and
+    returns their number"""
+
+    drained = 0
+    while socket.poll(0, zmq.POLLIN):
+      socket.recv(zmq.NOBLOCK)
+      drained += 1
+    return drained
+
+  def close(self):
+    """Closes all the pooled sockets and terminates the context"""
+
+    for socket in self._sockets.values():
+      socket.close()
+    self._sockets = {}
+
+    if self.context is not None:
+      self.context.term()
+      self.context = None
+
+
+## api functions
+
+def default_session():
+  """Returns the session shared by the api functions,
+  creates it if needed"""
+
+  global _default
+  with _default_lock:
+    if _default is None or _default.closed:
+      _default = Session()
+    return _default
+
+
+@atexit.register
+def _close_default_session():
+  if _default is not None and not _default.closed:
+    _default.close()
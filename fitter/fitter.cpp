@@ -174,9 +174,12 @@ int main (int ac, char* av[])
 		} while (threshold < 0.8);
 
 		// if "peaks" not in json object, then no distances and no gain can be computed
-		// push an "ERR" message in that case
+		// push an error message containing the request key in that case
 		if (result.empty()) {
-			s_send (sink, "ERR");
+			json error;
+			error["key"] = key;
+			error["error"] = "no peaks found";
+			s_send (sink, error.dump());
 			continue;
 		}
 		else {